@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+"""
+Main file
+"""
+
+import logging
+import sys
+
+RedactingFormatter = __import__('filtered_logger').RedactingFormatter
+
+formatter = RedactingFormatter(fields=("name", "email", "password"))
+
+record = logging.LogRecord("my_logger", logging.INFO, None, None,
+                           "login name=%s;", ("bob",), None)
+record.fields = {"email": "bob@dylan.com", "ip": "10.0.0.1"}
+print(formatter.format(record))
+
+try:
+    raise ValueError("bad password=hunter2;")
+except ValueError:
+    exc_info = sys.exc_info()
+record = logging.LogRecord("my_logger", logging.ERROR, None, None,
+                           "login failed", None, exc_info)
+record.fields = {"name": "bob"}
+print(formatter.format(record))
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Benchmarking the personal data logging pipeline.
+
+Synthetic log lines shaped like user_data.csv rows are redacted by each
+strategy in STRATEGIES for every combination of line length, number of
+PII fields and separator. Every run reports lines per second and the
+average bytes allocated per line (tracemalloc peak per call), and can
+write them as JSON so results are comparable between versions.
+
+Usage: ./benchmark_logger.py [-n 20000] [--lengths 128,512] [-o out.json]
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import re
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Sequence
+
+from filtered_logger import (PII_FIELDS, RedactingFormatter, TemplateCache,
+                             filter_datum, get_engine, get_logger)
+
+
+CSV_FIELDS = ('name', 'email', 'phone', 'ssn', 'password', 'ip',
+              'last_login', 'user_agent')
+ALLOC_SAMPLE = 500
+# strategies fed JSON versions of the generated lines
+JSON_STRATEGIES = ('json_stream', 'json_loads')
+
+Redactor = Callable[[str], str]
+
+
+def make_fields(count: int) -> List[str]:
+    """Returns count PII field names, PII_FIELDS first"""
+    extra = ['pii_{:03d}'.format(i) for i in range(count - len(PII_FIELDS))]
+    return list(PII_FIELDS[:count]) + extra
+
+
+def make_lines(count: int, length: int, fields: Sequence[str],
+               separator: str, seed: int = 0) -> List[str]:
+    """
+    Generates count log lines of about length characters holding the
+    user_data.csv columns plus every field in fields
+    """
+    rng = random.Random(seed)
+    keys = list(CSV_FIELDS) + [f for f in fields if f not in CSV_FIELDS]
+    lines = []
+    for i in range(count):
+        values = {
+            'name': 'User {}'.format(i),
+            'email': 'user{}@example.com'.format(i),
+            'phone': '({:03d}) {:03d}-{:04d}'.format(
+                rng.randrange(1000), rng.randrange(1000),
+                rng.randrange(10000)),
+            'ssn': '{:03d}-{:02d}-{:04d}'.format(
+                rng.randrange(1000), rng.randrange(100),
+                rng.randrange(10000)),
+            'password': '{:x}'.format(rng.getrandbits(48)),
+            'ip': '10.{}.{}.{}'.format(rng.randrange(256),
+                                       rng.randrange(256),
+                                       rng.randrange(256)),
+            'last_login': '2019-11-14T06:{:02d}:{:02d}'.format(
+                rng.randrange(60), rng.randrange(60)),
+            'user_agent': 'Mozilla/5.0',
+        }
+        parts = ['{}={}'.format(k, values.get(k, 'v{}'.format(i)))
+                 for k in keys]
+        line = separator.join(parts) + separator
+        if len(line) < length:
+            # pad the user agent, the column that varies most in practice
+            pad = 'x' * (length - len(line))
+            line = line.replace('user_agent=Mozilla/5.0',
+                                'user_agent=Mozilla/5.0 ' + pad, 1)
+        lines.append(line)
+    return lines
+
+
+def to_json_lines(lines: Sequence[str], separator: str) -> List[str]:
+    """Turns generated key=value lines into JSON object lines"""
+    result = []
+    for line in lines:
+        pairs = (part.partition('=') for part in line.split(separator)
+                 if part)
+        result.append(json.dumps({key: value for key, _, value in pairs}))
+    return result
+
+
+def _legacy(fields: Sequence[str], separator: str) -> Redactor:
+    """The original one re.sub per field implementation"""
+    redaction = RedactingFormatter.REDACTION
+
+    def redact(message: str) -> str:
+        for field in fields:
+            message = re.sub(field + '=' + '.+?' + separator,
+                             field + '=' + redaction + separator,
+                             message)
+        return message
+    return redact
+
+
+def _filter_datum(fields: Sequence[str], separator: str) -> Redactor:
+    """filter_datum as called by existing code"""
+    redaction = RedactingFormatter.REDACTION
+    return lambda message: filter_datum(fields, redaction, message,
+                                        separator)
+
+
+def _keyscan(fields: Sequence[str], separator: str) -> Redactor:
+    """The keyscan backend, called directly"""
+    return get_engine(tuple(fields), RedactingFormatter.REDACTION,
+                      separator, 'keyscan').redact
+
+
+def _template_cache(fields: Sequence[str], separator: str) -> Redactor:
+    """The regex engine behind a TemplateCache"""
+    engine = get_engine(tuple(fields), RedactingFormatter.REDACTION,
+                        separator)
+    return TemplateCache(engine).redact
+
+
+def _json_stream(fields: Sequence[str], separator: str) -> Redactor:
+    """The streaming JSON backend"""
+    return get_engine(tuple(fields), RedactingFormatter.REDACTION,
+                      separator, 'json').redact
+
+
+def _json_loads(fields: Sequence[str], separator: str) -> Redactor:
+    """Baseline JSON redaction: parse, mask and serialize again"""
+    keys = frozenset(fields)
+    redaction = RedactingFormatter.REDACTION
+
+    def mask(value):
+        if isinstance(value, dict):
+            return {k: redaction if k in keys else mask(v)
+                    for k, v in value.items()}
+        if isinstance(value, list):
+            return [mask(v) for v in value]
+        return value
+    return lambda message: json.dumps(mask(json.loads(message)))
+
+
+def _record(message: str) -> logging.LogRecord:
+    """Builds the LogRecord the formatter strategies consume"""
+    return logging.LogRecord("user_data", logging.INFO, None, None,
+                             message, None, None)
+
+
+def _make_formatter(fields: Sequence[str],
+                    separator: str) -> RedactingFormatter:
+    """RedactingFormatter for fields, splitting on separator"""
+    cls = type('RedactingFormatter', (RedactingFormatter,),
+               {'SEPARATOR': separator})
+    return cls(fields)
+
+
+def _formatter(fields: Sequence[str], separator: str) -> Redactor:
+    """RedactingFormatter.format on a fresh record"""
+    formatter = _make_formatter(fields, separator)
+    return lambda message: formatter.format(_record(message))
+
+
+def _logger(fields: Sequence[str], separator: str) -> Redactor:
+    """get_logger end to end, writing to the null device"""
+    logger = get_logger()
+    handler = logger.handlers[-1]
+    handler.setFormatter(_make_formatter(fields, separator))
+    handler.setStream(open(os.devnull, 'w'))
+    logger.handlers = [handler]
+    return logger.info
+
+
+STRATEGIES: Dict[str, Callable[[Sequence[str], str], Redactor]] = {
+    'legacy': _legacy,
+    'filter_datum': _filter_datum,
+    'keyscan': _keyscan,
+    'template_cache': _template_cache,
+    'json_stream': _json_stream,
+    'json_loads': _json_loads,
+    'formatter': _formatter,
+    'logger': _logger,
+}
+
+
+def measure(redact: Redactor, lines: Sequence[str]) -> Dict[str, float]:
+    """Times redact over lines and samples its allocations"""
+    for line in lines[:100]:
+        redact(line)
+    start = time.perf_counter()
+    for line in lines:
+        redact(line)
+    elapsed = time.perf_counter() - start
+
+    sample = lines[:ALLOC_SAMPLE]
+    peaks = 0
+    tracemalloc.start()
+    try:
+        for line in sample:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            redact(line)
+            peaks += tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return {
+        'lines_per_sec': len(lines) / elapsed if elapsed else 0.0,
+        'alloc_bytes_per_line': peaks / len(sample) if sample else 0.0,
+    }
+
+
+def run(strategies: Sequence[str], lengths: Sequence[int],
+        field_counts: Sequence[int], separators: Sequence[str],
+        count: int) -> List[dict]:
+    """Runs every strategy over every workload combination"""
+    results = []
+    for separator in separators:
+        for n_fields in field_counts:
+            fields = make_fields(n_fields)
+            for length in lengths:
+                lines = make_lines(count, length, fields, separator)
+                json_lines = None
+                if any(name in JSON_STRATEGIES for name in strategies):
+                    json_lines = to_json_lines(lines, separator)
+                for name in strategies:
+                    redact = STRATEGIES[name](fields, separator)
+                    result = {
+                        'strategy': name,
+                        'line_length': length,
+                        'fields': n_fields,
+                        'separator': separator,
+                        'lines': count,
+                    }
+                    result.update(measure(
+                        redact,
+                        json_lines if name in JSON_STRATEGIES else lines))
+                    results.append(result)
+                    print("{strategy:>14} len={line_length:<5} "
+                          "fields={fields:<4} sep={separator!r:<5} "
+                          "{lines_per_sec:>12,.0f} lines/s "
+                          "{alloc_bytes_per_line:>8,.0f} B/line".format(
+                              **result), file=sys.stderr)
+    return results
+
+
+def _csv_list(value: str) -> List[str]:
+    """Splits a comma separated command line value"""
+    return [v for v in value.split(',') if v]
+
+
+def main() -> None:
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the personal data redaction strategies")
+    parser.add_argument('-n', '--lines', type=int, default=20000,
+                        help="lines per measurement")
+    parser.add_argument('--lengths', default='128,512,2048',
+                        help="comma separated line lengths")
+    parser.add_argument('--fields', default='5,20,100',
+                        help="comma separated PII field counts")
+    parser.add_argument('--separators', default=';|',
+                        help="separator characters to try")
+    parser.add_argument('-s', '--strategies', default=','.join(STRATEGIES),
+                        help="comma separated strategies to run")
+    parser.add_argument('-o', '--output',
+                        help="write JSON results to this file ('-' stdout)")
+    args = parser.parse_args()
+
+    strategies = _csv_list(args.strategies)
+    for name in strategies:
+        if name not in STRATEGIES:
+            parser.error("unknown strategy {!r}".format(name))
+    results = run(strategies,
+                  [int(n) for n in _csv_list(args.lengths)],
+                  [int(n) for n in _csv_list(args.fields)],
+                  list(args.separators), args.lines)
+    if args.output:
+        report = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results,
+        }
+        if args.output == '-':
+            json.dump(report, sys.stdout, indent=2)
+        else:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,17 +5,37 @@ argument name password and will return a salted, hashed password,
 which is a byte string.
 
 Using the bcrypt package to perform hashing (with hashpw)
+
+hash_passwords and verify_many spread bulk work over a process pool
+and stream the results back in input order.
+
+The bcrypt cost comes from BCRYPT_ROUNDS (environment variable of the
+same name, 12 by default); calibrate_cost picks it for the current
+machine and needs_rehash flags hashes made with an outdated cost.
 """
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
 import bcrypt
 
 
-def hash_password(password: str) -> bytes:
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+MIN_ROUNDS = 4
+MAX_ROUNDS = 31
+
+
+def hash_password(password: str, rounds: int = None) -> bytes:
     """
     Taking in a password to hash and returing a salted
-    byte string.
+    byte string, using rounds (default BCRYPT_ROUNDS) as bcrypt cost.
     """
     password = bytes(password, 'utf-8')
-    hashed = bcrypt.hashpw(password, bcrypt.gensalt())
+    hashed = bcrypt.hashpw(password, bcrypt.gensalt(rounds or BCRYPT_ROUNDS))
 
     return hashed
 
@@ -28,3 +48,107 @@ def is_valid(hashed_password: bytes, password: str) -> bool:
         return True
     else:
         return False
+
+
+def hash_cost(hashed_password: bytes) -> int:
+    """
+    Returning the cost factor stored in a bcrypt hash
+    ($2b$<cost>$<salt+hash>)
+    """
+    try:
+        return int(hashed_password.split(b'$')[2])
+    except (IndexError, ValueError):
+        raise ValueError("not a bcrypt hash")
+
+
+def needs_rehash(hashed_password: bytes, rounds: int = None) -> bool:
+    """
+    Validating if hashed_password was made with a cost lower than
+    rounds (default BCRYPT_ROUNDS) and should be hashed again; a
+    higher cost is kept, so hosts calibrated differently never
+    downgrade each other's hashes
+    """
+    return hash_cost(hashed_password) < (rounds or BCRYPT_ROUNDS)
+
+
+def verify_and_rehash(hashed_password: bytes, password: str,
+                      rounds: int = None) -> Tuple[bool, Optional[bytes]]:
+    """
+    Validating password like is_valid and, when it matches a hash
+    with an outdated cost, returning a fresh hash to store instead.
+    Returns (is valid, new hash or None).
+    """
+    if not is_valid(hashed_password, password):
+        return False, None
+    if needs_rehash(hashed_password, rounds):
+        return True, hash_password(password, rounds)
+    return True, None
+
+
+def calibrate_cost(target_ms: float = 250, password: str = 'calibration',
+                   min_rounds: int = MIN_ROUNDS,
+                   max_rounds: int = MAX_ROUNDS) -> int:
+    """
+    Timing bcrypt on this machine and returning the highest cost whose
+    hash takes less than target_ms milliseconds (min_rounds at least).
+    Each extra round doubles the time, so timing stops at the first
+    cost over the target.
+    """
+    secret = password.encode('utf-8')
+    best = min_rounds
+    for rounds in range(min_rounds, max_rounds + 1):
+        salt = bcrypt.gensalt(rounds)
+        start = time.perf_counter()
+        bcrypt.hashpw(secret, salt)
+        elapsed = (time.perf_counter() - start) * 1000
+        if elapsed > target_ms:
+            break
+        best = rounds
+    return best
+
+
+def _is_valid_pair(pair: Tuple[bytes, str]) -> bool:
+    """is_valid over a (hashed_password, password) tuple"""
+    return is_valid(*pair)
+
+
+def _pool_map(func: Callable, items: Iterable,
+              workers: int = None) -> Iterator:
+    """
+    Yields func(item) for every item, in order, computed in a process
+    pool. Only a few tasks per worker are queued at a time so huge
+    iterables are consumed lazily.
+    """
+    workers = workers or os.cpu_count() or 1
+    pending = deque()
+    with ProcessPoolExecutor(workers) as pool:
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= 4 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def hash_passwords(passwords: Iterable[str], workers: int = None,
+                   rounds: int = None) -> Iterator[bytes]:
+    """
+    Hashing many passwords on all cores, yielding the hashes
+    in the same order as passwords.
+    """
+    func = partial(hash_password, rounds=rounds or BCRYPT_ROUNDS)
+    return _pool_map(func, passwords, workers)
+
+
+def verify_many(pairs: Iterable[Tuple[bytes, str]],
+                workers: int = None) -> Iterator[bool]:
+    """
+    Validating many (hashed_password, password) pairs on all cores,
+    yielding one bool per pair in input order.
+    """
+    return _pool_map(_is_valid_pair, pairs, workers)
+
+
+if __name__ == '__main__':
+    target = float(sys.argv[1]) if len(sys.argv) > 1 else 250
+    print("BCRYPT_ROUNDS={}".format(calibrate_cost(target)))
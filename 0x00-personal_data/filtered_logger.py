@@ -17,39 +17,716 @@
     filter_datum should be less than 5 lines long and use re.sub
     to perform the substitution with a single regex.
 """
+import argparse
+import atexit
+import gzip
+import json
 import mysql.connector
 import os
+import queue
 import re
+import stat
+import sys
+import threading
+import time
+import weakref
 import logging
-from typing import List
+import logging.handlers
+import mmap
+import sqlite3
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from typing import (Any, BinaryIO, Callable, Dict, List, Mapping, Optional,
+                    Pattern, Sequence, TextIO, Tuple)
 
 
 PII_FIELDS = ('name', 'email', 'phone', 'ssn', 'password')
+EXPORT_BATCH_SIZE = 1000
+EXPORT_BUFFER_SIZE = 1 << 20
+LOG_QUEUE_SIZE = 10000
+DB_POOL_SIZE = 5
+TEMPLATE_CACHE_SIZE = 256
+TEMPLATE_VARIANTS = 4
+# redaction latency bucket upper bounds in seconds, 1us to 1s
+LATENCY_BUCKETS = (1e-6, 2e-6, 5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4,
+                   1e-3, 2e-3, 5e-3, 1e-2, 2e-2, 5e-2, 0.1, 0.2, 0.5, 1.0)
+
+
+class RedactionEngine:
+    """ Redacts every field of a log line in a single regex pass
+
+    The alternation pattern is compiled once per
+    (fields, separator, redaction) combination and shared
+    through get_engine.
+    """
+
+    def __init__(self, fields: Sequence[str], redaction: str,
+                 separator: str):
+        self.fields = tuple(fields)
+        self.redaction = redaction
+        self.separator = separator
+        self.pattern = _compile_pattern(self.fields, separator)
+        # \g<1> keeps the matched field name; escape backslashes so the
+        # redaction string is inserted literally
+        self.template = r'\g<1>=' + (redaction + separator).replace(
+            '\\', r'\\')
+
+    def redact(self, message: str) -> str:
+        """Returns message with the values of all fields redacted"""
+        if self.pattern is None:
+            return message
+        return self.pattern.sub(self.template, message)
+
+
+def _compile_pattern(fields: Tuple[str, ...],
+                     separator: str) -> Optional[Pattern[str]]:
+    """Compiles one alternation pattern matching any field=value"""
+    if not fields:
+        return None
+    alternation = '|'.join(re.escape(field) for field in fields)
+    return re.compile('({})=.+?{}'.format(alternation,
+                                          re.escape(separator)))
+
+
+class KeyScanEngine:
+    """ Redacts fields by hashing the keys in front of each '='
+
+    Instead of trying every field at every position like the regex
+    alternation, it jumps from one '=' to the next and looks the text
+    just before it up in a set, one probe per distinct field length.
+    The cost per line depends on the number of key=value pairs, not on
+    how many fields are configured. Matches are the same as the regex
+    engine's: leftmost field=, value up to the next separator.
+    """
+
+    def __init__(self, fields: Sequence[str], redaction: str,
+                 separator: str):
+        self.fields = tuple(fields)
+        self.redaction = redaction
+        self.separator = separator
+        self._keys = frozenset(f for f in self.fields if f)
+        # longest first, so the earliest (leftmost) start wins
+        self._lengths = sorted({len(k) for k in self._keys}, reverse=True)
+
+    def redact(self, message: str) -> str:
+        """Returns message with the values of all fields redacted"""
+        keys = self._keys
+        if not keys:
+            return message
+        lengths = self._lengths
+        separator = self.separator
+        replacement = self.redaction + separator
+        find = message.find
+        parts = []
+        last = 0
+        eq = find('=')
+        while eq != -1:
+            for length in lengths:
+                start = eq - length
+                if start >= last and message[start:eq] in keys:
+                    break
+            else:
+                eq = find('=', eq + 1)
+                continue
+            # the value takes at least one character and no newline
+            end = find(separator, eq + 2)
+            if end == -1:
+                break
+            if find('\n', eq + 1, end) != -1:
+                eq = find('=', eq + 1)
+                continue
+            parts.append(message[last:eq + 1])
+            parts.append(replacement)
+            last = end + len(separator)
+            eq = find('=', last)
+        if not parts:
+            return message
+        parts.append(message[last:])
+        return ''.join(parts)
+
+
+_JSON_STRING = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+# a string, then for a key its colon and a string or scalar value
+_JSON_TOKEN = re.compile(
+    r'"([^"\\]*(?:\\.[^"\\]*)*)"(?:(\s*:\s*)({}|[^\s,\[\]{{}}"]+)?)?'.format(
+        _JSON_STRING))
+_JSON_SCALAR = re.compile(r'{}|[^\s,\]}}]+'.format(_JSON_STRING))
+_JSON_NESTED = re.compile(r'{}|[\[\]{{}}]'.format(_JSON_STRING))
+
+
+class JsonRedactionEngine:
+    """ Redacts the values of PII keys in JSON log lines
+
+    The line is never parsed into objects. Since in valid JSON a quote
+    not escaped by a backslash always delimits a string, the line is
+    walked from string token to string token and every key is looked up
+    in a set, so the cost per line depends on the number of keys in it,
+    not on how many fields are configured. Lines without backslashes
+    are simply split on quotes; others go through a token regex, keys
+    with escapes being decoded first. The value of a PII key, scalar or
+    nested, is replaced by the redaction as a JSON string and every
+    other character is copied verbatim, so field order and formatting
+    are preserved. The separator is unused.
+    """
+
+    KEY_VALUE = False
+
+    def __init__(self, fields: Sequence[str], redaction: str,
+                 separator: str):
+        self.fields = tuple(fields)
+        self.redaction = redaction
+        self.separator = separator
+        self._keys = frozenset(self.fields)
+        self._replacement = json.dumps(redaction)
+        self._content = self._replacement[1:-1]
+
+    @staticmethod
+    def _value_end(message: str, start: int) -> int:
+        """Returns where the JSON value starting at start ends"""
+        if message[start:start + 1] not in ('{', '['):
+            match = _JSON_SCALAR.match(message, start)
+            return match.end() if match else start
+        depth = 0
+        pos = start
+        while True:
+            match = _JSON_NESTED.search(message, pos)
+            if match is None:
+                return len(message)
+            token = match.group()
+            if token in ('{', '['):
+                depth += 1
+            elif token in ('}', ']'):
+                depth -= 1
+                if depth == 0:
+                    return match.end()
+            pos = match.end()
+
+    def _redact_plain(self, message: str) -> Optional[str]:
+        """
+        Redacts a line without backslashes, where the quotes split it
+        into structure (even parts) and strings (odd parts). Returns
+        None when a PII value is nested or the quotes are unbalanced.
+        """
+        parts = message.split('"')
+        if len(parts) % 2 == 0:
+            return None
+        keys = self._keys
+        content = self._content
+        last = len(parts) - 1
+        changed = False
+        for i in [i for i in range(1, last, 2) if parts[i] in keys]:
+            after = parts[i + 1]
+            if after == ': ' and i + 1 < last:
+                # the json.dumps layout, with a string value
+                parts[i + 2] = content
+                changed = True
+                continue
+            if after[:1] != ':' and after.lstrip()[:1] != ':':
+                # a string value, not a key
+                continue
+            colon = after.index(':') + 1
+            value = after[colon:].lstrip()
+            if not value:
+                # a string value, or nothing at the end of the line
+                if i + 1 < last:
+                    parts[i + 2] = content
+                    changed = True
+                continue
+            if value[0] in ('{', '['):
+                return None
+            start = len(after) - len(value)
+            match = _JSON_SCALAR.match(after, start)
+            if match is None:
+                continue
+            parts[i + 1] = (after[:start] + '"' + content + '"' +
+                            after[match.end():])
+            changed = True
+        return '"'.join(parts) if changed else message
+
+    def redact(self, message: str) -> str:
+        """Returns message with the values of all fields redacted"""
+        keys = self._keys
+        if not keys:
+            return message
+        if '\\' not in message:
+            redacted = self._redact_plain(message)
+            if redacted is not None:
+                return redacted
+        parts = []
+        last = 0
+        for match in _JSON_TOKEN.finditer(message):
+            if match.group(2) is None or match.start() < last:
+                # not a key, or inside a value already redacted
+                continue
+            key = match.group(1)
+            if '\\' in key:
+                key = json.loads('"' + key + '"')
+            if key not in keys:
+                continue
+            start = match.end(2)
+            if match.group(3) is None:
+                end = self._value_end(message, start)
+            else:
+                end = match.end()
+            if end > start:
+                parts.append(message[last:start])
+                parts.append(self._replacement)
+                last = end
+        if not parts:
+            return message
+        parts.append(message[last:])
+        return ''.join(parts)
+
+
+REDACTION_BACKENDS = {
+    'regex': RedactionEngine,
+    'keyscan': KeyScanEngine,
+    'json': JsonRedactionEngine,
+}
+
+
+@lru_cache(maxsize=128)
+def get_engine(fields: Tuple[str, ...], redaction: str,
+               separator: str, backend: str = 'regex') -> RedactionEngine:
+    """
+    Returns the cached engine for a fields/separator/redaction combo,
+    built by one of REDACTION_BACKENDS
+    """
+    if backend not in REDACTION_BACKENDS:
+        raise ValueError("unknown redaction backend {!r}".format(backend))
+    return REDACTION_BACKENDS[backend](fields, redaction, separator)
+
+
+class _Template:
+    """ Layout of one message template: a fullmatch pattern whose groups
+    are the PII values """
+
+    __slots__ = ('pattern', 'groups')
+
+    def __init__(self, pattern: Pattern[str], groups: int):
+        self.pattern = pattern
+        self.groups = groups
+
+
+class TemplateCache:
+    """ Redaction cache for messages built from a few templates
+
+    A template is the sequence of keys of a key=value message. The first
+    time a template is seen its message is redacted by the engine and a
+    pattern with one group per PII value is learnt from it; messages of
+    the same template are then redacted by slicing at the group spans of
+    a single anchored match. Messages that do not fit their cached
+    layout fall back to the engine. Templates live in a bounded LRU.
+    """
+
+    def __init__(self, engine: RedactionEngine,
+                 maxsize: int = TEMPLATE_CACHE_SIZE):
+        self.engine = engine
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        fields = [f for f in engine.fields if f]
+        separator = engine.separator
+        # layouts are only sound when keys cannot span separators or '='
+        self._enabled = getattr(engine, 'KEY_VALUE', True) and all(
+            separator not in f and '=' not in f and '\n' not in f
+            for f in fields) and bool(separator) and '=' not in separator
+        self._suffixes = frozenset(fields)
+        self._lengths = sorted({len(f) for f in fields})
+        if len(separator) == 1:
+            char = re.escape(separator)
+            self._value = '[^{}\n]+'.format(char)
+            self._plain = '[^={}\n]*'.format(char)
+            self._tail = '[^{}]*'.format(char)
+        else:
+            sep = re.escape(separator)
+            self._value = '(?:(?!{})[^\n])+'.format(sep)
+            self._plain = '(?:(?!{})[^=\n])*'.format(sep)
+            self._tail = '(?s:(?:(?!{}).)*)'.format(sep)
+
+    def _fingerprint(self, message: str) -> Tuple[int, str]:
+        """Cheap template key: separator count and first key"""
+        return message.count(self.engine.separator), message[
+            :message.find('=')]
+
+    def _is_pii(self, key: str) -> bool:
+        """Whether a field of the engine ends key"""
+        suffixes = self._suffixes
+        for length in self._lengths:
+            if length > len(key):
+                break
+            if key[len(key) - length:] in suffixes:
+                return True
+        return False
+
+    def _learn(self, message: str) -> Optional[_Template]:
+        """Builds the layout of message, None if it has no clean one"""
+        separator = self.engine.separator
+        segments = message.split(separator)
+        segments.pop()
+        parts = ['']
+        groups = 0
+        for segment in segments:
+            key, eq, _ = segment.partition('=')
+            if not eq or '\n' in key:
+                return None
+            if self._is_pii(key):
+                parts.append('{}=({}){}'.format(
+                    re.escape(key), self._value, re.escape(separator)))
+                groups += 1
+            else:
+                parts.append('{}={}{}'.format(
+                    re.escape(key), self._plain, re.escape(separator)))
+        parts.append(self._tail)
+        template = _Template(re.compile(''.join(parts)), groups)
+        if template.pattern.fullmatch(message) is None:
+            return None
+        return template
+
+    def _slice(self, template: _Template, message: str) -> Optional[str]:
+        """Redacts message along template, None if it does not fit"""
+        match = template.pattern.fullmatch(message)
+        if match is None:
+            return None
+        redaction = self.engine.redaction
+        parts = []
+        last = 0
+        for i in range(1, template.groups + 1):
+            parts.append(message[last:match.start(i)])
+            parts.append(redaction)
+            last = match.end(i)
+        parts.append(message[last:])
+        return ''.join(parts)
+
+    def redact(self, message: str) -> str:
+        """Returns message with the values of all fields redacted"""
+        if not self._enabled:
+            return self.engine.redact(message)
+        key = self._fingerprint(message)
+        templates = self._cache.get(key)
+        if templates is not None:
+            for template in templates:
+                redacted = self._slice(template, message)
+                if redacted is not None:
+                    self.hits += 1
+                    try:
+                        self._cache.move_to_end(key)
+                    except KeyError:
+                        pass
+                    return redacted
+        self.misses += 1
+        template = self._learn(message)
+        if template is not None:
+            with self._lock:
+                known = self._cache.setdefault(key, [])
+                # distinct templates may share a fingerprint; keep a few
+                known.insert(0, template)
+                del known[TEMPLATE_VARIANTS:]
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+        return self.engine.redact(message)
+
+    def stats(self) -> dict:
+        """Returns the hit/miss counters and the number of templates"""
+        return {'hits': self.hits, 'misses': self.misses,
+                'templates': len(self._cache)}
+
+
+class _Histogram:
+    """ One thread's latency counts for one logger name """
+
+    __slots__ = ('counts', 'count', 'bytes', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.bytes = 0
+        self.max = 0.0
+
+    def add(self, seconds: float, nbytes: int) -> None:
+        """Counts one call"""
+        self.counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.bytes += nbytes
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other: '_Histogram') -> None:
+        """Adds the counts of other"""
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.bytes += other.bytes
+        self.max = max(self.max, other.max)
+
+
+class _ThreadShard:
+    """ Holder of one thread's histograms, dropped when the thread ends """
+
+    __slots__ = ('histograms', '__weakref__')
+
+    def __init__(self):
+        self.histograms = {}
+
+
+class RedactionMetrics:
+    """ Redaction latency histograms tagged by logger name
+
+    Every thread records into its own histograms, so the hot path takes
+    no lock; snapshot() merges them. When a thread ends its histograms
+    are folded into a shared total, so thread-per-request servers keep
+    one shard per live thread. Buckets are LATENCY_BUCKETS and the
+    percentiles it reports are bucket upper bounds, in seconds.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        # {id(histograms): histograms} of the live threads
+        self._shards = {}
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float, nbytes: int) -> None:
+        """Adds one redaction call of the named logger"""
+        try:
+            shard = self._local.shard.histograms
+        except AttributeError:
+            holder = self._local.shard = _ThreadShard()
+            shard = holder.histograms
+            with self._lock:
+                self._shards[id(shard)] = shard
+            # runs when the thread's local storage is released
+            weakref.finalize(holder, self._retire, shard)
+        histogram = shard.get(name)
+        if histogram is None:
+            histogram = shard[name] = _Histogram()
+        histogram.add(seconds, nbytes)
+
+    @staticmethod
+    def _percentile(counts: List[int], total: int, maximum: float,
+                    fraction: float) -> float:
+        """Upper bound of the bucket holding the given fraction"""
+        rank = fraction * total
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if count and seen >= rank:
+                if i < len(LATENCY_BUCKETS):
+                    return min(LATENCY_BUCKETS[i], maximum)
+                return maximum
+        return maximum
+
+    def _retire(self, shard: Dict[str, _Histogram]) -> None:
+        """Folds the histograms of an ended thread into the total"""
+        with self._lock:
+            self._shards.pop(id(shard), None)
+            for name, histogram in shard.items():
+                self._retired.setdefault(name, _Histogram()).merge(
+                    histogram)
+
+    def snapshot(self) -> Dict[str, dict]:
+        """
+        Returns {logger name: {count, bytes, p50, p95, p99, max}}
+        merged over all threads
+        """
+        merged = {}
+        with self._lock:
+            shards = list(self._shards.values())
+            for name, histogram in self._retired.items():
+                merged.setdefault(name, _Histogram()).merge(histogram)
+        for shard in shards:
+            for name, histogram in list(shard.items()):
+                merged.setdefault(name, _Histogram()).merge(histogram)
+        result = {}
+        for name, total in merged.items():
+            stats = {'count': total.count, 'bytes': total.bytes,
+                     'max': total.max}
+            for label, fraction in (('p50', .5), ('p95', .95),
+                                    ('p99', .99)):
+                stats[label] = self._percentile(total.counts, total.count,
+                                                total.max, fraction)
+            result[name] = stats
+        return result
+
+    def reset(self) -> None:
+        """Clears every histogram"""
+        with self._lock:
+            self._retired.clear()
+            for shard in self._shards.values():
+                shard.clear()
+
+
+METRICS = RedactionMetrics()
 
 
 class RedactingFormatter(logging.Formatter):
     """ Redacting Formatter class
+
+    Records are redacted by the engine picked by backend ('regex',
+    'keyscan' for long field lists, or 'json' for JSON messages). A
+    non-zero template_cache puts a TemplateCache of that size in front
+    of it. Records carrying a mapping in their STRUCTURED_KEY attribute,
+    e.g. logger.info("login", extra={"fields": {"email": email}}), get
+    it appended as key=value pairs with the PII keys masked by lookup.
+    With metrics set, the time and size of every format call is
+    recorded there under the record's logger name.
         """
 
     REDACTION = "***"
     FORMAT = "[HOLBERTON] %(name)s %(levelname)s %(asctime)-15s: %(message)s"
     SEPARATOR = ";"
+    STRUCTURED_KEY = "fields"
 
-    def __init__(self, fields: List[str]):
+    def __init__(self, fields: List[str], backend: str = 'regex',
+                 template_cache: int = 0,
+                 metrics: RedactionMetrics = None):
         super(RedactingFormatter, self).__init__(self.FORMAT)
         self.fields = fields
+        self.metrics = metrics
+        self.engine = get_engine(tuple(fields), self.REDACTION,
+                                 self.SEPARATOR, backend)
+        self.template_cache = None
+        if template_cache:
+            self.template_cache = TemplateCache(self.engine, template_cache)
+        self._pii = frozenset(fields)
 
     def format(self, record: logging.LogRecord) -> str:
         """
         method that will filter values in incoming log records using filter_datum.
         Values for fields in fields should be filtered.
         """
-        return filter_datum(
-            self.fields, self.REDACTION, super().format(record),
-            self.SEPARATOR)
+        if self.metrics is None:
+            return self._redact(record)
+        start = time.perf_counter()
+        formatted = self._redact(record)
+        self.metrics.record(record.name, time.perf_counter() - start,
+                            len(formatted))
+        return formatted
+
+    def _redact(self, record: logging.LogRecord) -> str:
+        """Formats and redacts record"""
+        structured = getattr(record, self.STRUCTURED_KEY, None)
+        if isinstance(structured, Mapping):
+            return self.format_structured(record, structured)
+        if self.template_cache is not None and not (
+                record.exc_info or record.exc_text or record.stack_info):
+            # only the message varies by template, redact it on its own
+            return self._render(
+                record, self.template_cache.redact(record.getMessage()))
+        return self.engine.redact(super().format(record))
+
+    def format_structured(self, record: logging.LogRecord,
+                          structured: Mapping) -> str:
+        """
+        Renders record with the structured pairs appended to its message,
+        masking PII keys by lookup. Only the parts that may still hold
+        PII go through the engine: the message when it has args, and
+        any traceback or stack.
+        """
+        pii = self._pii
+        redaction = self.REDACTION
+        separator = self.SEPARATOR
+        pairs = ''.join(
+            '{}={}{}'.format(key, redaction if key in pii else value,
+                             separator)
+            for key, value in structured.items())
+        message = record.getMessage()
+        if record.args:
+            message = self.engine.redact(message)
+        return self._render(
+            record, '{} {}'.format(message, pairs) if message else pairs)
+
+    def _render(self, record: logging.LogRecord, message: str) -> str:
+        """
+        Formats record like format() with message, already redacted, in
+        place of its own, and the traceback and stack redacted
+        """
+        # like format(), set message and asctime but not msg and args,
+        # so other handlers still see the original record
+        record.message = message
+        if self.usesTime():
+            record.asctime = self.formatTime(record, self.datefmt)
+        formatted = self.formatMessage(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            if formatted[-1:] != '\n':
+                formatted += '\n'
+            formatted += self.engine.redact(record.exc_text)
+        if record.stack_info:
+            if formatted[-1:] != '\n':
+                formatted += '\n'
+            formatted += self.engine.redact(
+                self.formatStack(record.stack_info))
+        return formatted
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """ QueueHandler over a bounded queue with an overflow policy
+
+    Records that cannot be queued are counted in dropped.
+    """
+
+    OVERFLOW_POLICIES = ('block', 'drop-oldest', 'drop-new')
+
+    def __init__(self, maxsize: int = LOG_QUEUE_SIZE,
+                 overflow: str = 'block'):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("overflow must be one of {}".format(
+                ', '.join(self.OVERFLOW_POLICIES)))
+        super(BoundedQueueHandler, self).__init__(queue.Queue(maxsize))
+        self.overflow = overflow
+        self.dropped = 0
+        self._drop_lock = threading.Lock()
+
+    def _drop(self) -> None:
+        """Counts one dropped record"""
+        with self._drop_lock:
+            self.dropped += 1
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        """Queues record according to the overflow policy"""
+        if self.overflow == 'block':
+            self.queue.put(record)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                if self.overflow == 'drop-new':
+                    self._drop()
+                    return
+            # drop-oldest: make room by discarding the head of the queue
+            try:
+                self.queue.get_nowait()
+                self._drop()
+            except queue.Empty:
+                pass
 
 
-def get_logger() -> logging.Logger:
+class BoundedQueueListener(logging.handlers.QueueListener):
+    """ QueueListener that can be stopped while its queue is full
+    """
+
+    def enqueue_sentinel(self) -> None:
+        """Waits for room instead of failing on a full queue"""
+        self.queue.put(self._sentinel)
+
+    def stop(self) -> None:
+        """Drains the queue and stops the thread, once"""
+        if self._thread is not None:
+            super(BoundedQueueListener, self).stop()
+
+
+def get_logger(non_blocking: bool = False,
+               queue_size: int = LOG_QUEUE_SIZE,
+               overflow: str = 'block',
+               metrics: bool = False) -> logging.Logger:
     """
     Implementing a get_logger function that takes no arguments
     and returns a logging.Logger object.
@@ -63,6 +740,12 @@ def get_logger() -> logging.Logger:
     only 5 fields - choose the right list of fields that can are considered as
     “important” PIIs or information that you must hide in your logs. Use it to
     parameterize the formatter.
+
+    With non_blocking set, the logger gets a bounded QueueHandler instead
+    and a background QueueListener does the redaction and the write to
+    stderr, so callers never wait on the sink. overflow picks what happens
+    when the queue is full: 'block', 'drop-oldest' or 'drop-new'.
+    With metrics set, redaction latency is recorded in METRICS.
     """
     logger = logging.getLogger('user_data')
     logger.setLevel(logging.INFO)
@@ -71,26 +754,179 @@ def get_logger() -> logging.Logger:
     ch = logging.StreamHandler()
     ch.setLevel(logging.INFO)
     # streamhandler with redacting formatter
-    ch.setFormatter(RedactingFormatter)
+    ch.setFormatter(RedactingFormatter(
+        PII_FIELDS, metrics=METRICS if metrics else None))
+    if non_blocking:
+        # a new queue handler replaces the one of an earlier call
+        for old in list(logger.handlers):
+            if isinstance(old, BoundedQueueHandler):
+                logger.removeHandler(old)
+                atexit.unregister(old.listener.stop)
+                old.listener.stop()
+        # redaction and I/O happen on the listener thread
+        qh = BoundedQueueHandler(queue_size, overflow)
+        qh.listener = BoundedQueueListener(
+            qh.queue, ch, respect_handler_level=True)
+        qh.listener.start()
+        atexit.register(qh.listener.stop)
+        ch = qh
     # add handler to logger
     logger.addHandler(ch)
 
     return logger
 
 
-def get_db() -> mysql.connector.connection.MySQLConnection:
-    """Returns a connector to the database"""
+class PooledConnection:
+    """ Connection checked out of a ConnectionPool
+
+    Behaves like the wrapped connection, except that close() (or leaving
+    a with block) hands it back to the pool instead of closing it.
+    """
+
+    def __init__(self, pool: 'ConnectionPool', conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name: str):
+        return getattr(self._conn, name)
+
+    def __enter__(self) -> 'PooledConnection':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Returns the connection to its pool"""
+        if self._conn is not None:
+            self._pool.release(self._conn)
+            self._conn = None
+
+
+class ConnectionPool:
+    """ Fixed size pool of database connections
+
+    Connections are opened lazily up to size, checked with a SELECT 1
+    on checkout and replaced when the check fails.
+    """
+
+    def __init__(self, connect: Callable[[], Any], size: int = DB_POOL_SIZE):
+        if size < 1:
+            raise ValueError("pool size must be at least 1")
+        self._connect = connect
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @staticmethod
+    def _is_healthy(conn) -> bool:
+        """Checks that conn still answers a trivial query"""
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            cursor.close()
+        except Exception:
+            return False
+        return True
+
+    def acquire(self, timeout: float = None):
+        """Checks a raw connection out, waiting up to timeout seconds"""
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError("no database connection available")
+        try:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if self._is_healthy(conn):
+                    return conn
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn) -> None:
+        """Puts a checked out connection back in the pool"""
+        try:
+            conn.rollback()
+            self._idle.put(conn)
+        except Exception:
+            # a broken connection is simply dropped
+            pass
+        finally:
+            self._slots.release()
+
+    def connection(self, timeout: float = None) -> PooledConnection:
+        """Checks a connection out, usable as a context manager"""
+        return PooledConnection(self, self.acquire(timeout))
+
+    def close(self) -> None:
+        """Closes every idle connection"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _connector() -> Callable[[], Any]:
+    """
+    Reads the PERSONAL_DATA_DB_* variables and returns a callable opening
+    a connection with them. PERSONAL_DATA_DB_ENGINE=sqlite uses
+    PERSONAL_DATA_DB_NAME as a local SQLite file instead of MySQL.
+    """
+    db = os.environ["PERSONAL_DATA_DB_NAME"]
+    if os.environ.get("PERSONAL_DATA_DB_ENGINE", "mysql") == "sqlite":
+        return partial(sqlite3.connect, db, check_same_thread=False)
     host = os.environ["PERSONAL_DATA_DB_HOST"]
     user = os.environ["PERSONAL_DATA_DB_USERNAME"]
     passwd = os.environ["PERSONAL_DATA_DB_PASSWORD"]
-    db = os.environ["PERSONAL_DATA_DB_NAME"]
-    connect = mysql.connector.connect(
-            host=host,
-            user=user,
-            passwd=passwd,
-            database=db
-    )
-    return connect
+    return partial(mysql.connector.connect,
+                   host=host,
+                   user=user,
+                   passwd=passwd,
+                   database=db)
+
+
+def get_pool(size: int = None) -> ConnectionPool:
+    """
+    Returns the process-wide connection pool, creating it on first use.
+    size defaults to PERSONAL_DATA_DB_POOL_SIZE and only applies then.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            if size is None:
+                size = int(os.environ.get("PERSONAL_DATA_DB_POOL_SIZE",
+                                          DB_POOL_SIZE))
+            _pool = ConnectionPool(_connector(), size)
+            atexit.register(_pool.close)
+    return _pool
+
+
+def get_db(pooled: bool = False
+           ) -> mysql.connector.connection.MySQLConnection:
+    """
+    Returns a connector to the database.
+    With pooled set the connection comes from get_pool() and goes back
+    to it on close().
+    """
+    if pooled:
+        return get_pool().connection()
+    return _connector()()
 
 
 def filter_datum(fields: List[str],
@@ -98,37 +934,453 @@ def filter_datum(fields: List[str],
                  message: str,
                  separator: str) -> str:
     """Takes in a message and obsficates indicated fields"""
-    for field in fields:
-        message = re.sub(field + '=' + '.+?' + separator,
-                         field + '=' + redaction + separator,
-                         message)
-    return message
+    return get_engine(tuple(fields), redaction, separator).redact(message)
 
 
-if __name__ == '__main__':
-    db = get_db()
-    cursor = db.cursor()
-    query = "SELECT group_concat(COLUMN_NAME) FROM INFORMATION_SCHEMA.COLUMNS\
-            WHERE TABLE_SCHEMA = 'my_db' AND TABLE_NAME = 'users';"
-    cursor.execute(query)
+@lru_cache(maxsize=128)
+def _compile_bytes_pattern(fields: Tuple[str, ...],
+                           separator: bytes) -> Optional[Pattern[bytes]]:
+    """Compiles the bytes counterpart of the field alternation pattern"""
+    if not fields:
+        return None
+    alternation = b'|'.join(re.escape(field.encode()) for field in fields)
+    return re.compile(b'(' + alternation + b')=.+?' + re.escape(separator))
+
+
+def filter_datum_bytes(fields: List[str],
+                       redaction: bytes,
+                       message: bytes,
+                       separator: bytes) -> bytes:
+    """Bytes version of filter_datum, no decoding involved"""
+    pattern = _compile_bytes_pattern(tuple(fields), separator)
+    if pattern is None:
+        return message
+    template = br'\g<1>=' + (redaction + separator).replace(b'\\', b'\\\\')
+    return pattern.sub(template, message)
+
+
+def redact_mmap(path: str, out: BinaryIO, fields: Sequence[str],
+                redaction: bytes = b'***',
+                separator: bytes = b';') -> int:
+    """
+    Redacts the file at path into out through a memory map.
+
+    The bytes pattern runs straight over the mapping and untouched spans
+    are written as memoryview slices, so no line is ever copied into a
+    Python bytes or str object. Returns the number of fields redacted.
+    """
+    pattern = _compile_bytes_pattern(tuple(fields), separator)
+    count = 0
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return count
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                last = 0
+                replacement = redaction + separator
+                if pattern is not None:
+                    for match in pattern.finditer(mm):
+                        # keep "field=" from the source, replace the value
+                        out.write(view[last:match.end(1) + 1])
+                        out.write(replacement)
+                        last = match.end()
+                        count += 1
+                out.write(view[last:])
+            finally:
+                view.release()
+    return count
+
+
+class TableLayout:
+    """ Column names and positions of a table with a precomputed row
+    formatter built from them
+    """
+
+    def __init__(self, table: str, columns: Sequence[str]):
+        self.table = table
+        self.columns = tuple(columns)
+        self.positions = {name: i for i, name in enumerate(self.columns)}
+        template = '; '.join(
+            '{}={{}}'.format(name.replace('{', '{{').replace('}', '}}'))
+            for name in self.columns) + ';'
+        # 'name=value; ...;' message of a row, with one format call
+        self.message = template.format
+
+
+_layouts: Dict[str, TableLayout] = {}
+
+
+def table_layout(table: str, description: Sequence) -> TableLayout:
+    """
+    Returns the cached layout of table for a cursor description.
+
+    The column names sent with every result set are the invalidation
+    key: the layout is rebuilt only when they differ from the cached
+    ones, so no INFORMATION_SCHEMA query is needed.
+    """
+    columns = tuple(column[0] for column in description)
+    layout = _layouts.get(table)
+    if layout is None or layout.columns != columns:
+        layout = _layouts[table] = TableLayout(table, columns)
+    return layout
+
+
+def _stream_cursor(db):
+    """Returns an unbuffered cursor where the driver supports it"""
+    try:
+        return db.cursor(buffered=False)
+    except TypeError:
+        # sqlite3 cursors always stream
+        return db.cursor()
 
-    for row in cursor:
-        keys = row[0]
 
-    keys = keys.split(',')
+def _format_batch(layout: TableLayout, rows: Sequence[Sequence],
+                  formatter: RedactingFormatter) -> str:
+    """Renders rows as redacted log lines, one per line"""
+    message = layout.message
+    lines = []
+    for row in rows:
+        record = logging.LogRecord("user_data", logging.INFO, None,
+                                   None, message(*row), None, None)
+        lines.append(formatter.format(record))
+    lines.append('')
+    return '\n'.join(lines)
 
+
+def _write_rows(cursor, formatter: RedactingFormatter, out: TextIO,
+                batch_size: int, table: str = 'users') -> int:
+    """
+    Drains an executed cursor into out as redacted log lines, one
+    fetchmany batch and one write at a time. Returns the row count.
+    """
+    layout = table_layout(table, cursor.description)
+    count = 0
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        out.write(_format_batch(layout, rows, formatter))
+        count += len(rows)
+    return count
+
+
+def export_users(db, out: TextIO,
+                 batch_size: int = EXPORT_BATCH_SIZE) -> int:
+    """
+    Streams the users table into out as redacted log lines.
+
+    Rows are pulled through an unbuffered cursor in fetchmany batches
+    so memory stays bounded by batch_size, and every batch is written
+    with a single call. Returns the number of rows exported.
+    """
+    formatter = RedactingFormatter(fields=PII_FIELDS)
+    cursor = _stream_cursor(db)
     cursor.execute("SELECT * FROM users;")
-    for row in cursor:
-        to_join = [f'{r}={s}' for r, s in zip(keys, row)]
-        message = "; ".join(to_join)
-        message += ';'
-        log_record = logging.LogRecord("user_data", logging.INFO, None, None,
-                                       message, None, None)
+    try:
+        return _write_rows(cursor, formatter, out, batch_size)
+    finally:
+        cursor.close()
+
+
+def load_checkpoint(path: str) -> dict:
+    """Returns the saved watermark, empty for a first run"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
 
-        formatter = RedactingFormatter(fields=("name", "email", "phone", "ssn",
-                                               "password"))
 
-        print(formatter.format(log_record))
+def save_checkpoint(path: str, checkpoint: dict) -> None:
+    """Replaces the checkpoint file atomically"""
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def export_incremental(db, out: TextIO, checkpoint_path: str,
+                       batch_size: int = EXPORT_BATCH_SIZE) -> int:
+    """
+    Appends the users changed since the last run to out.
 
+    Rows are selected with last_login >= watermark ordered by last_login,
+    a predicate an index on last_login can serve. The checkpoint holds
+    the last exported last_login and how many rows carrying exactly that
+    value were already written, so ties are neither lost nor repeated.
+    It is replaced atomically after every batch once out is flushed, so
+    a crashed run resumes from its last complete batch (rows of the
+    batch in flight may be written twice). Returns the rows exported.
+    """
+    checkpoint = load_checkpoint(checkpoint_path)
+    watermark = checkpoint.get('last_login')
+    skip = checkpoint.get('seen', 0)
+    formatter = RedactingFormatter(fields=PII_FIELDS)
+    # pipes and terminals cannot be fsynced, only files
+    durable = stat.S_ISREG(os.fstat(out.fileno()).st_mode)
+    cursor = _stream_cursor(db)
+    layout = _layouts.get('users')
+    if layout is None:
+        cursor.execute("SELECT * FROM users LIMIT 0;")
+        cursor.fetchall()
+        layout = table_layout('users', cursor.description)
+    # the remaining columns only make the order of ties deterministic
+    order = ', '.join(
+        ['last_login'] + [str(i) for i in range(1, len(layout.columns) + 1)])
+    if watermark is None:
+        cursor.execute("SELECT * FROM users WHERE last_login IS NOT NULL "
+                       "ORDER BY {};".format(order))
+    else:
+        cursor.execute("SELECT * FROM users WHERE last_login >= {} "
+                       "ORDER BY {};".format(_placeholder(), order),
+                       (watermark,))
+    layout = table_layout('users', cursor.description)
+    column = layout.positions['last_login']
+    count = 0
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            if skip:
+                # drop the ties of the watermark exported by the last run
+                head = 0
+                while head < len(rows) and skip and \
+                        str(rows[head][column]) == watermark:
+                    head += 1
+                    skip -= 1
+                if head < len(rows):
+                    skip = 0
+                rows = rows[head:]
+                if not rows:
+                    continue
+            out.write(_format_batch(layout, rows, formatter))
+            out.flush()
+            if durable:
+                os.fsync(out.fileno())
+            count += len(rows)
+            last = str(rows[-1][column])
+            ties = sum(1 for row in rows if str(row[column]) == last)
+            if last == watermark:
+                ties += checkpoint.get('seen', 0)
+            watermark = last
+            checkpoint = {'last_login': watermark, 'seen': ties}
+            save_checkpoint(checkpoint_path, checkpoint)
+    finally:
+        cursor.close()
+    return count
+
+
+def _placeholder() -> str:
+    """Returns the query parameter marker of the configured driver"""
+    if os.environ.get("PERSONAL_DATA_DB_ENGINE", "mysql") == "sqlite":
+        return "?"
+    return "%s"
+
+
+def _shard_queries(db, shards: int,
+                   key: str) -> List[Tuple[str, tuple]]:
+    """
+    Splits the users table into shards (query, params) pairs, equal
+    ranges of the numeric key column, rows with a NULL key going to the
+    first one. The key should be indexed, so that each shard reads only
+    its own range.
+    """
+    if not re.fullmatch(r'\w+', key):
+        raise ValueError("invalid key column {!r}".format(key))
+    p = _placeholder()
+    cursor = db.cursor()
+    cursor.execute("SELECT MIN({0}), MAX({0}) FROM users;".format(key))
+    low, high = cursor.fetchall()[0]
     cursor.close()
-    db.close()
+    if low is None:
+        return [("SELECT * FROM users;", ())]
+    step = (high - low) // shards + 1
+    queries = []
+    for i in range(shards):
+        query = "SELECT * FROM users WHERE ({0} >= {1} AND {0} < {1})"
+        if i == 0:
+            query += " OR {0} IS NULL"
+        queries.append((query.format(key, p) + ";",
+                        (low + i * step, low + (i + 1) * step)))
+    return queries
+
+
+def export_shard(part: int, query: str, params: tuple, path: str,
+                 batch_size: int = EXPORT_BATCH_SIZE) -> dict:
+    """
+    Exports one shard over its own connection into a gzip file and
+    returns its manifest entry. Runs in a worker process.
+    """
+    db = get_db()
+    formatter = RedactingFormatter(fields=PII_FIELDS)
+    cursor = _stream_cursor(db)
+    try:
+        cursor.execute(query, params)
+        with gzip.open(path, 'wt', compresslevel=6) as out:
+            count = _write_rows(cursor, formatter, out, batch_size)
+    finally:
+        cursor.close()
+        db.close()
+    return {'part': part, 'file': os.path.basename(path), 'rows': count,
+            'query': query, 'params': list(params)}
+
+
+def export_batch(description: Sequence, rows: List[tuple]) -> bytes:
+    """
+    Returns rows as redacted log lines compressed into one gzip member.
+    Runs in a worker process.
+    """
+    formatter = RedactingFormatter(fields=PII_FIELDS)
+    text = _format_batch(table_layout('users', description), rows,
+                         formatter)
+    return gzip.compress(text.encode(), compresslevel=6)
+
+
+def _part_path(out_dir: str, part: int) -> str:
+    """Returns the path of a part file of a sharded export"""
+    return os.path.join(out_dir, 'users.part-{:04d}.log.gz'.format(part))
+
+
+def _export_split(out_dir: str, shards: int,
+                  batch_size: int) -> List[dict]:
+    """
+    Reads the users table once, over a single cursor and so a single
+    snapshot, and hands its batches round robin to shards worker
+    processes that redact and compress them. Each part file is the gzip
+    members of its batches, in order. Returns the manifest entries.
+    """
+    query = "SELECT * FROM users;"
+    files = [open(_part_path(out_dir, i), 'wb') for i in range(shards)]
+    counts = [0] * shards
+    pending = deque()
+    db = get_db()
+    cursor = _stream_cursor(db)
+    try:
+        with ProcessPoolExecutor(shards) as pool:
+            cursor.execute(query)
+            # plain tuples, the driver's description may not pickle
+            description = tuple((column[0],)
+                                for column in cursor.description)
+            part = 0
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                pending.append(
+                    (part, pool.submit(export_batch, description, rows)))
+                counts[part] += len(rows)
+                part = (part + 1) % shards
+                # bound the batches held in memory
+                while len(pending) > 2 * shards:
+                    i, future = pending.popleft()
+                    files[i].write(future.result())
+            while pending:
+                i, future = pending.popleft()
+                files[i].write(future.result())
+    finally:
+        cursor.close()
+        db.close()
+        for f in files:
+            f.close()
+    return [{'part': i, 'file': os.path.basename(_part_path(out_dir, i)),
+             'rows': counts[i], 'query': query, 'params': []}
+            for i in range(shards)]
+
+
+def export_sharded(out_dir: str, shards: int, key: str = None,
+                   batch_size: int = EXPORT_BATCH_SIZE) -> dict:
+    """
+    Exports the users table as shards gzip parts written in parallel
+    and writes manifest.json listing them. Returns the manifest.
+
+    With a key column each part is a key range read by its own worker
+    process over its own connection. Without one a single cursor reads
+    the table and the workers only redact and compress its batches.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    if key is None:
+        parts = _export_split(out_dir, shards, batch_size)
+    else:
+        db = get_db()
+        try:
+            queries = _shard_queries(db, shards, key)
+        finally:
+            db.close()
+        with ProcessPoolExecutor(len(queries)) as pool:
+            futures = [
+                pool.submit(export_shard, i, query, params,
+                            _part_path(out_dir, i), batch_size)
+                for i, (query, params) in enumerate(queries)]
+            parts = [future.result() for future in futures]
+    manifest = {'table': 'users', 'key': key,
+                'rows': sum(part['rows'] for part in parts),
+                'parts': parts}
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def main() -> None:
+    """Exports the users table as redacted log lines"""
+    parser = argparse.ArgumentParser(
+        description="Export the users table as redacted log lines")
+    parser.add_argument('-o', '--output', default='-',
+                        help="output file, '-' for stdout (default)")
+    parser.add_argument('-b', '--batch-size', type=int,
+                        default=EXPORT_BATCH_SIZE,
+                        help="rows fetched per round trip")
+    parser.add_argument('-c', '--checkpoint',
+                        help="export only rows with a newer last_login "
+                             "than this checkpoint file, appending to "
+                             "--output")
+    parser.add_argument('-j', '--shards', type=int, default=0,
+                        help="export in this many parallel gzip parts "
+                             "into the --output directory")
+    parser.add_argument('-k', '--key',
+                        help="indexed numeric column to split shards on, "
+                             "each read over its own connection (default: "
+                             "one reader handing batches to the shards)")
+    args = parser.parse_args()
+
+    if args.shards:
+        if args.output == '-':
+            parser.error("--shards needs an --output directory")
+        start = time.perf_counter()
+        count = export_sharded(args.output, args.shards, args.key,
+                               args.batch_size)['rows']
+        elapsed = time.perf_counter() - start
+        print("exported {} rows in {} parts in {:.2f}s ({:.0f} rows/s)"
+              .format(count, args.shards, elapsed,
+                      count / elapsed if elapsed else 0), file=sys.stderr)
+        return
+
+    db = get_db()
+    if args.output == '-':
+        out = sys.stdout
+    else:
+        out = open(args.output, 'a' if args.checkpoint else 'w',
+                   buffering=EXPORT_BUFFER_SIZE)
+    start = time.perf_counter()
+    try:
+        if args.checkpoint:
+            count = export_incremental(db, out, args.checkpoint,
+                                       args.batch_size)
+        else:
+            count = export_users(db, out, args.batch_size)
+    finally:
+        out.flush()
+        if out is not sys.stdout:
+            out.close()
+        db.close()
+    elapsed = time.perf_counter() - start
+    print("exported {} rows in {:.2f}s ({:.0f} rows/s)".format(
+        count, elapsed, count / elapsed if elapsed else 0),
+        file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Redacting user_data.csv-style exports column by column.
+
+The CSV is read in chunks of rows; inside a chunk the rows are
+transposed so every PII column is replaced at once, and the chunk is
+written back out. No per-row log string is ever built and memory is
+bounded by the chunk size. Files ending in .gz go through gzip.
+
+Usage: ./redact_csv.py [-f name,email] [-c 10000] input.csv output.csv
+"""
+import argparse
+import csv
+import gzip
+import sys
+import time
+from itertools import islice
+from typing import List, Sequence, TextIO
+
+from filtered_logger import PII_FIELDS, RedactingFormatter
+
+
+CHUNK_ROWS = 10000
+
+
+def open_csv(path: str, mode: str) -> TextIO:
+    """Opens a CSV file for the csv module, through gzip for .gz files"""
+    if path == '-':
+        return sys.stdin if 'r' in mode else sys.stdout
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', newline='', encoding='utf-8')
+    return open(path, mode, newline='', encoding='utf-8')
+
+
+def redact_rows(rows: List[List[str]], columns: Sequence[int], width: int,
+                redaction: str) -> List[Sequence[str]]:
+    """Masks the given column indexes of a chunk of rows"""
+    if all(len(row) == width for row in rows):
+        table = list(zip(*rows))
+        masked = (redaction,) * len(rows)
+        for i in columns:
+            table[i] = masked
+        return list(zip(*table))
+    # ragged rows would be truncated by zip: mask them one by one
+    for row in rows:
+        for i in columns:
+            if i < len(row):
+                row[i] = redaction
+    return rows
+
+
+def redact_csv(src: TextIO, dst: TextIO,
+               fields: Sequence[str] = PII_FIELDS,
+               redaction: str = RedactingFormatter.REDACTION,
+               chunk_rows: int = CHUNK_ROWS,
+               quoting: int = csv.QUOTE_MINIMAL) -> int:
+    """
+    Streams the CSV in src to dst with the fields columns redacted.
+    The first row is the header. Returns the number of data rows.
+    """
+    reader = csv.reader(src)
+    writer = csv.writer(dst, quoting=quoting)
+    header = next(reader, None)
+    if header is None:
+        return 0
+    writer.writerow(header)
+    wanted = set(fields)
+    columns = [i for i, name in enumerate(header) if name in wanted]
+    count = 0
+    while True:
+        rows = list(islice(reader, chunk_rows))
+        if not rows:
+            break
+        writer.writerows(redact_rows(rows, columns, len(header),
+                                     redaction))
+        count += len(rows)
+    return count
+
+
+def main() -> None:
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(
+        description="Redact PII columns of a CSV export")
+    parser.add_argument('input', help="CSV file to read, '-' for stdin")
+    parser.add_argument('output', help="CSV file to write, '-' for stdout")
+    parser.add_argument('-f', '--fields', default=','.join(PII_FIELDS),
+                        help="comma separated columns to redact")
+    parser.add_argument('-r', '--redaction',
+                        default=RedactingFormatter.REDACTION)
+    parser.add_argument('-c', '--chunk-rows', type=int, default=CHUNK_ROWS,
+                        help="rows per chunk")
+    parser.add_argument('--quote-all', action='store_true',
+                        help="quote every field like user_data.csv")
+    args = parser.parse_args()
+
+    quoting = csv.QUOTE_ALL if args.quote_all else csv.QUOTE_MINIMAL
+    start = time.perf_counter()
+    src = open_csv(args.input, 'r')
+    dst = open_csv(args.output, 'w')
+    try:
+        count = redact_csv(src, dst, [f for f in args.fields.split(',') if f],
+                           args.redaction, args.chunk_rows, quoting)
+    finally:
+        dst.flush()
+        if args.output != '-':
+            dst.close()
+        if args.input != '-':
+            src.close()
+    elapsed = time.perf_counter() - start
+    print("redacted {} rows in {:.2f}s ({:.0f} rows/s)".format(
+        count, elapsed, count / elapsed if elapsed else 0), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
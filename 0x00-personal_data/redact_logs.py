@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Re-redacting existing log files with filter_datum.
+
+The input is split into newline-aligned chunks that are redacted in a
+process pool and written back in their original order, so the work
+scales with the number of cores. Files ending in .gz are read and
+written through gzip.
+
+Usage: ./redact_logs.py [-f name,email] [-j 8] input.log[.gz] output[.gz]
+"""
+import argparse
+import gzip
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Iterator, Sequence
+
+from filtered_logger import PII_FIELDS, RedactingFormatter, get_engine
+
+
+CHUNK_SIZE = 4 << 20
+ENCODING = 'utf-8'
+ERRORS = 'surrogateescape'
+
+_engine = None
+
+
+def _init_worker(fields: Sequence[str], redaction: str,
+                 separator: str) -> None:
+    """Builds the redaction engine once per worker process"""
+    global _engine
+    _engine = get_engine(tuple(fields), redaction, separator)
+
+
+def redact_chunk(chunk: bytes) -> bytes:
+    """Redacts a block of complete log lines"""
+    # the value pattern never crosses a newline, so a whole block
+    # redacts exactly like its lines one by one
+    text = chunk.decode(ENCODING, ERRORS)
+    return _engine.redact(text).encode(ENCODING, ERRORS)
+
+
+def open_log(path: str, mode: str) -> BinaryIO:
+    """Opens path in binary mode, through gzip for .gz files"""
+    if path == '-':
+        return sys.stdin.buffer if 'r' in mode else sys.stdout.buffer
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 'b', compresslevel=6)
+    return open(path, mode + 'b')
+
+
+def iter_chunks(stream: BinaryIO,
+                chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Yields blocks of about chunk_size bytes ending on a newline"""
+    tail = b''
+    while True:
+        block = stream.read(chunk_size)
+        if not block:
+            break
+        block = tail + block
+        cut = block.rfind(b'\n') + 1
+        if cut == 0:
+            # no newline yet: keep growing the pending line
+            tail = block
+            continue
+        tail = block[cut:]
+        yield block[:cut]
+    if tail:
+        yield tail
+
+
+def redact_stream(src: BinaryIO, dst: BinaryIO, fields: Sequence[str],
+                  redaction: str = RedactingFormatter.REDACTION,
+                  separator: str = RedactingFormatter.SEPARATOR,
+                  workers: int = None,
+                  chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    Redacts src into dst with a pool of worker processes.
+
+    At most two chunks per worker are in flight, so memory stays bounded
+    whatever the input size. Returns the number of bytes read.
+    """
+    workers = workers or os.cpu_count() or 1
+    total = 0
+    pending = deque()
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(tuple(fields), redaction,
+                                       separator)) as pool:
+        for chunk in iter_chunks(src, chunk_size):
+            total += len(chunk)
+            pending.append(pool.submit(redact_chunk, chunk))
+            if len(pending) >= 2 * workers:
+                dst.write(pending.popleft().result())
+        while pending:
+            dst.write(pending.popleft().result())
+    return total
+
+
+def main() -> None:
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(
+        description="Redact PII fields in existing log files")
+    parser.add_argument('input', help="log file to read, '-' for stdin")
+    parser.add_argument('output', help="file to write, '-' for stdout")
+    parser.add_argument('-f', '--fields', default=','.join(PII_FIELDS),
+                        help="comma separated fields to redact")
+    parser.add_argument('-r', '--redaction',
+                        default=RedactingFormatter.REDACTION)
+    parser.add_argument('-s', '--separator',
+                        default=RedactingFormatter.SEPARATOR)
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help="worker processes (default: all cores)")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help="bytes per chunk handed to a worker")
+    args = parser.parse_args()
+
+    fields = [f for f in args.fields.split(',') if f]
+    start = time.perf_counter()
+    src = open_log(args.input, 'r')
+    dst = open_log(args.output, 'w')
+    try:
+        total = redact_stream(src, dst, fields, args.redaction,
+                              args.separator, args.workers, args.chunk_size)
+    finally:
+        dst.flush()
+        if args.output != '-':
+            dst.close()
+        if args.input != '-':
+            src.close()
+    elapsed = time.perf_counter() - start
+    print("redacted {:.1f} MiB in {:.2f}s ({:.1f} MiB/s)".format(
+        total / (1 << 20), elapsed,
+        total / (1 << 20) / elapsed if elapsed else 0), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+""" Benchmark the timestamp codec of models.base
+
+Compares the strptime/strftime path with parse_timestamp,
+format_timestamp and the cached to_json on N User objects.
+
+Usage: ./benchmark_timestamps.py [-n 100000]
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+
+from models.base import TIMESTAMP_FORMAT, format_timestamp, parse_timestamp
+from models.user import User
+
+
+def legacy_to_json(obj, for_serialization: bool = False) -> dict:
+    """ Base.to_json with one strftime per datetime
+    """
+    result = {}
+    for key, value in obj.__dict__.items():
+        if not for_serialization and key[0] == '_':
+            continue
+        if type(value) is datetime:
+            result[key] = value.strftime(TIMESTAMP_FORMAT)
+        else:
+            result[key] = value
+    return result
+
+
+def timed(label: str, func, count: int) -> float:
+    """ Run func once, print and return its time per item
+    """
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print("{:<28} {:8.3f}s {:8.2f}us/object".format(
+        label, elapsed, elapsed / count * 1e6))
+    return elapsed
+
+
+def main():
+    """ Command line entry point
+    """
+    parser = argparse.ArgumentParser(description="Benchmark timestamps")
+    parser.add_argument('-n', '--count', type=int, default=100000,
+                        help="number of objects")
+    args = parser.parse_args()
+
+    count = args.count
+    base = datetime(2023, 1, 1)
+    stamps = [(base + timedelta(seconds=i * 7)).strftime(TIMESTAMP_FORMAT)
+              for i in range(count)]
+    kwargs = [{'created_at': s, 'updated_at': s, 'email': "u{}".format(i)}
+              for i, s in enumerate(stamps)]
+    for s in stamps[:1000]:
+        assert parse_timestamp(s) == datetime.strptime(s, TIMESTAMP_FORMAT)
+
+    timed("parse strptime", lambda: [
+        datetime.strptime(s, TIMESTAMP_FORMAT) for s in stamps], count)
+    timed("parse parse_timestamp", lambda: [
+        parse_timestamp(s) for s in stamps], count)
+
+    dates = [parse_timestamp(s) for s in stamps]
+    timed("format strftime", lambda: [
+        d.strftime(TIMESTAMP_FORMAT) for d in dates], count)
+    timed("format format_timestamp", lambda: [
+        format_timestamp(d) for d in dates], count)
+
+    users = []
+    timed("User(**kwargs)", lambda: users.extend(
+        User(**kw) for kw in kwargs), count)
+    timed("to_json strftime", lambda: [
+        legacy_to_json(u) for u in users], count)
+    timed("to_json first call", lambda: [u.to_json() for u in users], count)
+    timed("to_json cached", lambda: [u.to_json() for u in users], count)
+    assert all(u.to_json() == legacy_to_json(u) for u in users)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+""" Main 5: journal replay after a crash between rotation and snapshot
+"""
+import os
+import tempfile
+
+from models.base import DATA
+from models.user_session import UserSession
+
+os.chdir(tempfile.mkdtemp())
+
+UserSession.load_from_file()
+sessions = [UserSession(user_id="u{}".format(i), session_id="s{}".format(i))
+            for i in range(10)]
+UserSession.bulk_save(sessions)
+UserSession.flush()
+
+""" Rotate the journal like a compaction, then crash before the snapshot """
+journal = UserSession._journal()
+with journal.lock:
+    journal.close()
+    os.replace(journal.path, journal.old_path)
+
+sessions[0].remove()
+sessions[1].session_id = "renamed"
+sessions[1].save()
+UserSession.flush()
+expected = {k: v.to_json(True) for k, v in DATA['UserSession'].items()}
+print(sorted(f for f in os.listdir('.') if f.startswith('.db_')))
+
+UserSession.load_from_file()
+loaded = {k: v.to_json(True) for k, v in DATA['UserSession'].items()}
+print("{} sessions replayed, same state: {}".format(
+    len(loaded), loaded == expected))
+print(UserSession.search({'session_id': "renamed"})[0].user_id)
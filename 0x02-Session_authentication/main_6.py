@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+""" Main 6: writes from threads coalesced by the background flusher
+"""
+import os
+import tempfile
+import threading
+
+from models.base import DATA
+from models.user_session import UserSession
+
+os.chdir(tempfile.mkdtemp())
+
+UserSession.load_from_file()
+UserSession.FLUSH_INTERVAL = 0.05
+UserSession.JOURNAL_COMPACT_SIZE = 16 << 10
+
+
+def worker(n):
+    """ Save sessions and remove one in three """
+    for i in range(500):
+        session = UserSession(user_id="u{}".format(n),
+                              session_id="s{}-{}".format(n, i))
+        session.save()
+        if i % 3 == 0:
+            session.remove()
+
+
+threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+UserSession.flush()
+journal = UserSession._journal()
+with journal.compacting:
+    pass
+expected = {k: v.to_json(True) for k, v in DATA['UserSession'].items()}
+
+UserSession.load_from_file()
+loaded = {k: v.to_json(True) for k, v in DATA['UserSession'].items()}
+print("{} sessions, journal {} bytes, same state: {}".format(
+    len(loaded), os.path.getsize(journal.path), loaded == expected))
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+""" Main 7: deferred writes are flushed when the interpreter exits
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+from models.user_session import UserSession
+
+project = os.path.dirname(os.path.abspath(__file__))
+os.chdir(tempfile.mkdtemp())
+
+""" The child saves with a one hour flush interval and exits at once """
+child = """
+from models.user_session import UserSession
+UserSession.FLUSH_INTERVAL = 3600
+for i in range(100):
+    UserSession(user_id="u", session_id="s{}".format(i)).save()
+"""
+subprocess.run([sys.executable, "-c", child], check=True,
+               env=dict(os.environ, PYTHONPATH=project))
+
+UserSession.load_from_file()
+print("{} sessions written at exit".format(UserSession.count()))
+print(UserSession.search({'session_id': "s99"})[0].user_id)
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+""" Main 8: lazy and eager loads build the same objects
+"""
+import os
+import tempfile
+
+from models.base import DATA
+from models.user import User
+
+os.chdir(tempfile.mkdtemp())
+
+User.load_from_file()
+users = []
+for i in range(1000):
+    user = User(email="user{}@hbtn.io".format(i), first_name="User")
+    user.password = "pwd{}".format(i)
+    users.append(user)
+User.bulk_save(users)
+
+for serializer in ('binary', 'json'):
+    User.SERIALIZER = serializer
+    User.LAZY = False
+    User.load_from_file()
+    eager = {k: v.to_json(True) for k, v in DATA['User'].items()}
+    User.LAZY = True
+    User.load_from_file()
+    print("{}: {} records, {} built".format(
+        serializer, User.count(),
+        sum(type(v) is User for v in dict.values(DATA['User']))))
+    found = User.search({'email': "user42@hbtn.io"})[0]
+    print(found.is_valid_password("pwd42"))
+    lazy = {k: v.to_json(True) for k, v in DATA['User'].items()}
+    print("lazy == eager: {}".format(lazy == eager))
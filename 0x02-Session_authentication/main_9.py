@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+""" Main 9: a single-line .db_User.json is migrated to the binary store
+"""
+import json
+import os
+import tempfile
+
+from models.base import DATA
+from models.user import User
+
+os.chdir(tempfile.mkdtemp())
+
+""" The file as the original save_to_file wrote it """
+users = {}
+for i in range(100):
+    user_id = "id-{}".format(i)
+    users[user_id] = {
+        "id": user_id,
+        "created_at": "2023-01-01T00:00:00",
+        "updated_at": "2023-01-02T03:04:05",
+        "email": "user{}@hbtn.io".format(i),
+        "_password": None,
+        "first_name": "User",
+        "last_name": str(i),
+    }
+with open(".db_User.json", 'w') as f:
+    json.dump(users, f)
+
+User.load_from_file()
+print(sorted(f for f in os.listdir('.') if f.startswith('.db_')))
+loaded = {k: v.to_json(True) for k, v in DATA['User'].items()}
+print("{} users migrated, same data: {}".format(
+    len(loaded), loaded == users))
+User.load_from_file()
+print(User.get("id-7").updated_at)
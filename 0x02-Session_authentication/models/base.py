@@ -1,21 +1,385 @@
 #!/usr/bin/env python3
 """ Base module
 """
+from contextlib import contextmanager
 from datetime import datetime
 from typing import TypeVar, List, Iterable
 from os import path
+import atexit
 import json
+import mmap
+import os
+import shutil
+import threading
 import uuid
 
+from models.serializers import SERIALIZERS
+
 
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
 DATA = {}
+# {class name: {attribute: {value: {id: None}}}}, built on first search
+INDEX = {}
+# {class name: {id: {attribute: indexed value}}}
+INDEXED = {}
+# held to build, drop or update the indexes
+_index_lock = threading.RLock()
+# {class name: Journal}
+JOURNALS = {}
+# {class name: Flusher}
+FLUSHERS = {}
+_journals_lock = threading.Lock()
+# per thread {class name: records of the open batch}
+_batches = threading.local()
+
+
+def parse_timestamp(value: str) -> datetime:
+    """ Parse a TIMESTAMP_FORMAT string
+
+    Strings with exactly the TIMESTAMP_FORMAT layout go through the C
+    ISO parser, anything else through strptime and its errors.
+    """
+    if len(value) == 19 and value[4] == value[7] == '-' and \
+            value[10] == 'T' and value[13] == value[16] == ':':
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    return datetime.strptime(value, TIMESTAMP_FORMAT)
+
+
+def format_timestamp(value: datetime) -> str:
+    """ Format a naive datetime with TIMESTAMP_FORMAT
+    """
+    return value.isoformat(timespec='seconds')
+
+
+class Journal():
+    """ Append-only log of the mutations of one class
+
+    Each line is a JSON record, {"op": "save", "obj": {...}} or
+    {"op": "remove", "id": ...}, replayed over the .db_<Class>.*
+    snapshot on load. Compacting rotates the log to .journal.old,
+    writes a fresh snapshot and deletes the rotated log, so a crash at
+    any point leaves snapshot + old + current replaying to the same
+    state.
+    """
+
+    def __init__(self, model: type):
+        """ Initialize the journal of a Base subclass
+        """
+        self.model = model
+        self.path = ".db_{}.journal".format(model.__name__)
+        self.old_path = self.path + ".old"
+        # lock guards the open file; compacting is held for a whole
+        # compaction, possibly by the background thread
+        self.lock = threading.Lock()
+        self.compacting = threading.Lock()
+        self.file = None
+        self.size = 0
+
+    def append(self, *records: dict):
+        """ Write records, compacting once the log is large enough
+        """
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a')
+                self.size = path.getsize(self.path)
+            self.file.write(lines)
+            self.file.flush()
+            if self.model.FSYNC:
+                os.fsync(self.file.fileno())
+            self.size += len(lines)
+            full = self.size >= self.model.JOURNAL_COMPACT_SIZE
+        if full and self.compacting.acquire(blocking=False):
+            threading.Thread(target=self._compact_and_release,
+                             daemon=True).start()
+
+    def replay(self, objs: dict):
+        """ Apply the rotated then the current log to objs
+        """
+        with self.compacting, self.lock:
+            for file_path in (self.old_path, self.path):
+                if not path.exists(file_path):
+                    continue
+                with open(file_path, 'r') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            # torn last line of a crashed append
+                            continue
+                        if record.get('op') == 'save':
+                            obj = self.model(**record['obj'])
+                            objs[obj.id] = obj
+                        elif record.get('op') == 'remove':
+                            objs.pop(record.get('id'), None)
+
+    def close(self):
+        """ Close the log file, it is reopened on the next append
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def compact(self):
+        """ Fold the log into a new snapshot
+        """
+        with self.compacting:
+            self._compact()
+
+    def _compact_and_release(self):
+        """ Background compaction, started with compacting held
+        """
+        try:
+            self._compact()
+        finally:
+            self.compacting.release()
+
+    def _compact(self):
+        """ Rotate the log and write the snapshot, compacting held
+        """
+        with self.lock:
+            self.close()
+            if path.exists(self.path):
+                if path.exists(self.old_path):
+                    # a compaction died before deleting it: keep both
+                    with open(self.path, 'r') as src, \
+                            open(self.old_path, 'a') as dst:
+                        shutil.copyfileobj(src, dst)
+                    os.remove(self.path)
+                else:
+                    os.replace(self.path, self.old_path)
+            self.size = 0
+            # a plain copy, lazy records are written back untouched
+            objs = dict.copy(DATA.get(self.model.__name__, {}))
+        # appends go to a new log while the snapshot is written
+        self.model._write_snapshot(objs)
+        if path.exists(self.old_path):
+            os.remove(self.old_path)
+
+
+class Flusher():
+    """ Deferred persistence of one class
+
+    Mutations only mark the class dirty (and queue their journal
+    record); a daemon thread writes them at most once per
+    FLUSH_INTERVAL seconds, or as soon as FLUSH_MUTATIONS are pending.
+    """
+
+    def __init__(self, model: type):
+        """ Initialize the flusher of a Base subclass
+        """
+        self.model = model
+        self.cond = threading.Condition()
+        # held while pending writes reach the disk, keeps them ordered
+        self.writing = threading.Lock()
+        self.records = []
+        self.mutations = 0
+        self.thread = None
+
+    def mark(self, *records: dict):
+        """ Queue mutations
+        """
+        with self.cond:
+            if self.model.STORAGE == 'journal':
+                self.records.extend(records)
+            self.mutations += len(records)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run,
+                                               daemon=True)
+                self.thread.start()
+            if self.mutations >= self.model.FLUSH_MUTATIONS:
+                self.cond.notify()
+
+    def flush(self):
+        """ Write the pending mutations now
+        """
+        with self.writing:
+            with self.cond:
+                records, self.records = self.records, []
+                mutations, self.mutations = self.mutations, 0
+            if not mutations:
+                return
+            if self.model.STORAGE == 'journal':
+                self.model._journal().append(*records)
+            else:
+                self.model._journal().compact()
+
+    def _run(self):
+        """ Flush loop of the background thread
+        """
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.mutations)
+                self.cond.wait_for(
+                    lambda: self.mutations >= self.model.FLUSH_MUTATIONS,
+                    timeout=self.model.FLUSH_INTERVAL)
+            self.flush()
+
+
+@atexit.register
+def flush_all():
+    """ Write every pending mutation, waiting for running compactions
+    """
+    for flusher in list(FLUSHERS.values()):
+        flusher.flush()
+    for journal in list(JOURNALS.values()):
+        with journal.compacting:
+            journal.close()
+
+
+class LazyRecord():
+    """ Span of a not yet built object in a mapped snapshot file
+    """
+
+    __slots__ = ('source', 'start', 'end', 'serializer')
+
+    def __init__(self, source: mmap.mmap, start: int, end: int,
+                 serializer):
+        """ Initialize a record at source[start:end]
+        """
+        self.source = source
+        self.start = start
+        self.end = end
+        self.serializer = serializer
+
+    def raw(self) -> bytes:
+        """ Return the encoded object
+        """
+        return self.source[self.start:self.end]
+
+    def fields(self) -> dict:
+        """ Return the decoded attributes
+        """
+        return self.serializer.decode(self.raw())
+
+
+class LazyObjects(dict):
+    """ {id: object} map of a class with LAZY = True
+
+    Loading only maps the snapshot and records where each object's
+    line is; objects are built the first time they are read through
+    [], get, values or items.
+    """
+
+    def __init__(self, model: type):
+        """ Initialize an empty map of model objects
+        """
+        super().__init__()
+        self.model = model
+        self.lock = threading.Lock()
+
+    def _build(self, key: str, value):
+        """ Return value, building it first if it is a LazyRecord
+        """
+        if type(value) is not LazyRecord:
+            return value
+        with self.lock:
+            value = dict.get(self, key)
+            if type(value) is LazyRecord:
+                value = self.model(**dict(value.fields(), id=key))
+                dict.__setitem__(self, key, value)
+        return value
+
+    def __getitem__(self, key: str):
+        """ Return the object of key
+        """
+        return self._build(key, dict.__getitem__(self, key))
+
+    def get(self, key: str, default=None):
+        """ Return the object of key, default if there is none
+        """
+        return self._build(key, dict.get(self, key, default))
+
+    def values(self) -> list:
+        """ Return every object
+        """
+        return [self[key] for key in list(self)]
+
+    def items(self) -> list:
+        """ Return every (id, object) pair
+        """
+        return [(key, self[key]) for key in list(self)]
+
+
+class IndexedAttribute():
+    """ Attribute listed in INDEXES, re-indexing stored objects when set
+
+    Only the indexed attributes pay for the descriptor.
+    """
+
+    def __init__(self, name: str):
+        """ Initialize the descriptor of attribute name
+        """
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        """ Return the value stored in the instance
+        """
+        if obj is None:
+            return self
+        try:
+            return obj.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name) from None
+
+    def __set__(self, obj, value):
+        """ Store value, re-indexing obj if it is stored
+        """
+        obj.__dict__[self.name] = value
+        # raw lookup: a lazy record is never this object
+        objs = DATA.get(obj.__class__.__name__, {})
+        if dict.get(objs, obj.__dict__.get('id')) is obj:
+            obj._index_update()
 
 
 class Base():
     """ Base class
+
+    Attributes listed in INDEXES get a hash index that search uses for
+    equality; the first search builds it, then save, remove and
+    setting an indexed attribute of a stored object maintain it.
+
+    SERIALIZER names the format of the class file in SERIALIZERS; a
+    file in another format is converted on load and kept as a .bak
+    backup. With LAZY = True load_from_file only maps the file and
+    objects are built on first access (see LazyObjects).
+
+    With STORAGE = 'snapshot' every save or remove rewrites the class
+    file; with 'journal' it appends one record to the class journal,
+    compacted in the background past JOURNAL_COMPACT_SIZE bytes.
+
+    DURABILITY = 'sync' writes on the calling thread; 'interval' defers
+    the write to a background flusher (see Flusher), with flush() and
+    interpreter exit writing whatever is pending. FSYNC forces every
+    write down to the disk.
+
+    to_json keeps the formatted timestamps in the TRANSIENT _timestamps
+    attribute, reused while the datetime attributes stay the same.
     """
 
+    INDEXES = ()
+    SERIALIZER = 'json'
+    LAZY = False
+    STORAGE = 'snapshot'
+    JOURNAL_COMPACT_SIZE = 1 << 20
+    DURABILITY = 'sync'
+    FLUSH_INTERVAL = 1.0
+    FLUSH_MUTATIONS = 1000
+    FSYNC = False
+    # attributes never serialized
+    TRANSIENT = ('_timestamps',)
+
+    def __init_subclass__(cls, **kwargs):
+        """ Give the attributes in INDEXES an IndexedAttribute
+        """
+        super().__init_subclass__(**kwargs)
+        for name in cls.INDEXES:
+            if name not in cls.__dict__:
+                setattr(cls, name, IndexedAttribute(name))
+
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
         """
@@ -23,15 +387,20 @@ class Base():
         if DATA.get(s_class) is None:
             DATA[s_class] = {}
 
+        # {attribute: (datetime, formatted)} cache of to_json, set here
+        # so to_json never grows __dict__ under a concurrent encoder
+        self._timestamps = {}
         self.id = kwargs.get('id', str(uuid.uuid4()))
-        if kwargs.get('created_at') is not None:
-            self.created_at = datetime.strptime(kwargs.get('created_at'),
-                                                TIMESTAMP_FORMAT)
+        if isinstance(kwargs.get('created_at'), datetime):
+            self.created_at = kwargs.get('created_at')
+        elif kwargs.get('created_at') is not None:
+            self.created_at = parse_timestamp(kwargs.get('created_at'))
         else:
             self.created_at = datetime.utcnow()
-        if kwargs.get('updated_at') is not None:
-            self.updated_at = datetime.strptime(kwargs.get('updated_at'),
-                                                TIMESTAMP_FORMAT)
+        if isinstance(kwargs.get('updated_at'), datetime):
+            self.updated_at = kwargs.get('updated_at')
+        elif kwargs.get('updated_at') is not None:
+            self.updated_at = parse_timestamp(kwargs.get('updated_at'))
         else:
             self.updated_at = datetime.utcnow()
 
@@ -48,42 +417,277 @@ class Base():
         """ Convert the object a JSON dictionary
         """
         result = {}
-        for key, value in self.__dict__.items():
+        stamps = self._timestamps
+        # a copy: writer threads may encode the object meanwhile
+        for key, value in list(self.__dict__.items()):
             if not for_serialization and key[0] == '_':
                 continue
+            if key in self.TRANSIENT:
+                continue
             if type(value) is datetime:
-                result[key] = value.strftime(TIMESTAMP_FORMAT)
+                cached = stamps.get(key)
+                if cached is None or cached[0] is not value:
+                    cached = (value, format_timestamp(value))
+                    stamps[key] = cached
+                result[key] = cached[1]
             else:
                 result[key] = value
         return result
 
+    @classmethod
+    def _reindex(cls):
+        """ Build the indexes from all objects, unless already built
+
+        The indexes are filled aside and published at once, so that a
+        concurrent search never reads them half built.
+        """
+        s_class = cls.__name__
+        with _index_lock:
+            if s_class in INDEX:
+                return
+            index = {attr: {} for attr in cls.INDEXES}
+            indexed = {}
+            # raw items: lazy objects are indexed from their JSON
+            for obj_id, obj in list(dict.items(DATA.get(s_class, {}))):
+                if type(obj) is LazyRecord:
+                    fields = obj.fields()
+                    values = {attr: fields.get(attr)
+                              for attr in cls.INDEXES}
+                else:
+                    values = {attr: getattr(obj, attr, None)
+                              for attr in cls.INDEXES}
+                cls._index_put(index, indexed, obj_id, values)
+            INDEXED[s_class] = indexed
+            INDEX[s_class] = index
+
+    @staticmethod
+    def _index_put(index: dict, indexed: dict, obj_id: str, values: dict):
+        """ Index obj_id under the given attribute values
+        """
+        kept = {}
+        for attr, value in values.items():
+            try:
+                index[attr].setdefault(value, {})[obj_id] = None
+            except TypeError:
+                # unhashable values are only found by a full scan
+                continue
+            kept[attr] = value
+        indexed[obj_id] = kept
+
+    def _index_update(self):
+        """ Re-index this object under its current values
+        """
+        if not self.INDEXES:
+            return
+        with _index_lock:
+            self._index_remove()
+            self._index_add()
+
+    def _index_add(self):
+        """ Index the current values of this object
+        """
+        s_class = self.__class__.__name__
+        if not self.INDEXES or s_class not in INDEX:
+            return
+        self._index_put(INDEX[s_class], INDEXED[s_class], self.id,
+                        {attr: getattr(self, attr, None)
+                         for attr in self.INDEXES})
+
+    def _index_remove(self):
+        """ Drop the values this object was indexed under
+        """
+        s_class = self.__class__.__name__
+        values = INDEXED.get(s_class, {}).pop(self.id, None)
+        if values is None:
+            return
+        for attr, value in values.items():
+            bucket = INDEX[s_class][attr].get(value)
+            if bucket is not None:
+                bucket.pop(self.id, None)
+                if not bucket:
+                    del INDEX[s_class][attr][value]
+
     @classmethod
     def load_from_file(cls):
         """ Load all objects from file
         """
         s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        DATA[s_class] = {}
-        if not path.exists(file_path):
-            return
+        serializer = SERIALIZERS[cls.SERIALIZER]
+        file_path = cls._file_path(serializer)
+        cls.flush()
+        DATA[s_class] = LazyObjects(cls) if cls.LAZY else {}
+        with _index_lock:
+            INDEX.pop(s_class, None)
+            INDEXED.pop(s_class, None)
+        if path.exists(file_path):
+            cls._read_snapshot(file_path, serializer, cls.LAZY)
+        else:
+            for other in SERIALIZERS.values():
+                other_path = cls._file_path(other)
+                if other is serializer or not path.exists(other_path):
+                    continue
+                # convert the file to the class format, keeping the
+                # original as a backup
+                cls._read_snapshot(other_path, other, False)
+                cls._write_snapshot(DATA[s_class])
+                os.replace(other_path, other_path + ".bak")
+                break
+        cls._journal().replay(DATA[s_class])
 
-        with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+    @classmethod
+    def _file_path(cls, serializer=None) -> str:
+        """ Return the class file name in the format of serializer,
+        the class one by default
+        """
+        serializer = serializer or SERIALIZERS[cls.SERIALIZER]
+        return ".db_{}{}".format(cls.__name__, serializer.EXTENSION)
+
+    @classmethod
+    def _read_snapshot(cls, file_path: str, serializer, lazy: bool):
+        """ Add the objects of a class file to DATA
+        """
+        objs = DATA[cls.__name__]
+        if path.getsize(file_path) == 0:
+            return
+        with open(file_path, 'rb') as f:
+            source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        spans = serializer.spans(source)
+        if spans is None:
+            for obj_id, fields in serializer.load_all(source).items():
+                objs[obj_id] = cls(**fields)
+        elif lazy:
+            # the records keep source mapped until they are built
+            for obj_id, start, end in spans:
+                dict.__setitem__(objs, obj_id,
+                                 LazyRecord(source, start, end, serializer))
+            return
+        else:
+            for obj_id, start, end in spans:
+                fields = serializer.decode(source[start:end])
+                fields['id'] = obj_id
+                objs[obj_id] = cls(**fields)
+        source.close()
 
     @classmethod
     def save_to_file(cls):
-        """ Save all objects to file
+        """ Save all objects to file, folding in any journal
+        """
+        cls._journal().compact()
+
+    @classmethod
+    def _write_snapshot(cls, objs: dict):
+        """ Atomically replace the class file with the {id: object} objs
+        """
+        serializer = SERIALIZERS[cls.SERIALIZER]
+        file_path = cls._file_path(serializer)
+
+        def records():
+            # raw items: lazy records of the same format are copied
+            for obj_id, obj in dict.items(objs):
+                if type(obj) is LazyRecord:
+                    if obj.serializer is serializer:
+                        yield obj_id, obj.raw()
+                        continue
+                    obj = cls(**dict(obj.fields(), id=obj_id))
+                yield obj_id, serializer.encode(obj)
+
+        tmp_path = file_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            serializer.dump(f, records())
+            if cls.FSYNC:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+
+    @classmethod
+    def _journal(cls) -> Journal:
+        """ Return the journal of the class
+        """
+        s_class = cls.__name__
+        journal = JOURNALS.get(s_class)
+        if journal is None:
+            with _journals_lock:
+                journal = JOURNALS.setdefault(s_class, Journal(cls))
+        return journal
+
+    @classmethod
+    def _flusher(cls) -> Flusher:
+        """ Return the flusher of the class
+        """
+        s_class = cls.__name__
+        flusher = FLUSHERS.get(s_class)
+        if flusher is None:
+            with _journals_lock:
+                flusher = FLUSHERS.setdefault(s_class, Flusher(cls))
+        return flusher
+
+    @classmethod
+    def flush(cls):
+        """ Write the mutations deferred by the flusher
+        """
+        flusher = FLUSHERS.get(cls.__name__)
+        if flusher is not None:
+            flusher.flush()
+
+    @classmethod
+    def _persist(cls, *records: dict):
+        """ Write or defer mutations, following the class policy
+        """
+        batch = getattr(_batches, cls.__name__, None)
+        if batch is not None:
+            batch.extend(records)
+        elif cls.DURABILITY == 'interval':
+            cls._flusher().mark(*records)
+        elif cls.STORAGE == 'journal':
+            cls._journal().append(*records)
+        else:
+            cls.save_to_file()
+
+    @classmethod
+    @contextmanager
+    def batch(cls):
+        """ Persist the saves and removes of the block once, at its end
+
+        Objects change in memory right away; the class file is written
+        once on leaving the block, even when it raises.
         """
         s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        objs_json = {}
-        for obj_id, obj in DATA[s_class].items():
-            objs_json[obj_id] = obj.to_json(True)
+        if getattr(_batches, s_class, None) is not None:
+            # nested: the outer batch persists
+            yield
+            return
+        records = []
+        setattr(_batches, s_class, records)
+        try:
+            yield
+        finally:
+            delattr(_batches, s_class)
+            if records:
+                cls._persist(*records)
 
-        with open(file_path, 'w') as f:
-            json.dump(objs_json, f)
+    @classmethod
+    def bulk_save(cls, objs: Iterable[TypeVar('Base')]):
+        """ Save many objects with a single write
+        """
+        with cls.batch():
+            for obj in objs:
+                obj.save()
+
+    @classmethod
+    def bulk_remove(cls, ids: Iterable[str]) -> int:
+        """ Remove many objects by ID with a single write
+
+        Unknown IDs are ignored; returns the number of objects removed.
+        """
+        s_class = cls.__name__
+        count = 0
+        with cls.batch():
+            for obj_id in ids:
+                obj = DATA.get(s_class, {}).get(obj_id)
+                if obj is not None:
+                    obj.remove()
+                    count += 1
+        return count
 
     def save(self):
         """ Save current object
@@ -91,7 +695,8 @@ class Base():
         s_class = self.__class__.__name__
         self.updated_at = datetime.utcnow()
         DATA[s_class][self.id] = self
-        self.__class__.save_to_file()
+        self._index_update()
+        self._persist({'op': 'save', 'obj': self.to_json(True)})
 
     def remove(self):
         """ Remove object
@@ -99,7 +704,9 @@ class Base():
         s_class = self.__class__.__name__
         if DATA[s_class].get(self.id) is not None:
             del DATA[s_class][self.id]
-            self.__class__.save_to_file()
+            with _index_lock:
+                self._index_remove()
+            self._persist({'op': 'remove', 'id': self.id})
 
     @classmethod
     def count(cls) -> int:
@@ -124,6 +731,10 @@ class Base():
     @classmethod
     def search(cls, attributes: dict = {}) -> List[TypeVar('Base')]:
         """ Search all objects with matching attributes
+
+        An equality on an indexed attribute narrows the candidates to
+        its index bucket; the index follows the current values of the
+        stored objects and is built by the first search after a load.
         """
         s_class = cls.__name__
         def _search(obj):
@@ -133,5 +744,20 @@ class Base():
                 if (getattr(obj, k) != v):
                     return False
             return True
-        
-        return list(filter(_search, DATA[s_class].values()))
+
+        objs = DATA[s_class]
+        if cls.INDEXES and s_class not in INDEX:
+            cls._reindex()
+        candidates = None
+        index = INDEX.get(s_class, {})
+        for k, v in attributes.items():
+            if k not in index:
+                continue
+            try:
+                candidates = [objs[i] for i in index[k].get(v, ())]
+            except TypeError:
+                continue
+            break
+        if candidates is None:
+            candidates = objs.values()
+        return list(filter(_search, candidates))
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+""" Serializers module
+
+A serializer writes and reads the snapshot file of a Base subclass,
+.db_<Class><EXTENSION>, as a sequence of (id, record bytes) pairs:
+- encode(obj) and decode(raw) convert one object
+- dump(f, records) writes the file from (id, encode(obj)) pairs
+- spans(source) yields (id, start, end) of every record in the mapped
+  file, so objects can be built one by one or lazily, or returns None
+  when the file has to be decoded whole by load_all(source)
+"""
+from datetime import datetime, timedelta
+from typing import BinaryIO, Dict, Iterable, Iterator, Optional, Tuple
+import json
+import re
+import struct
+
+
+EPOCH = datetime(1970, 1, 1)
+SECOND = timedelta(seconds=1)
+
+
+class JsonSerializer():
+    """ JSON object with one `"<id>": {...}` line per object
+    """
+
+    EXTENSION = ".json"
+    # one `"<id>": <object JSON>` line of a snapshot file
+    RECORD_LINE = re.compile(
+        rb'^("[^"\\\n]*(?:\\.[^"\\\n]*)*"): (\{.*\})', re.M)
+
+    def encode(self, obj) -> bytes:
+        """ Return the JSON of obj
+        """
+        return json.dumps(obj.to_json(True)).encode()
+
+    def decode(self, raw: bytes) -> dict:
+        """ Return the attributes of a record
+        """
+        return json.loads(raw)
+
+    def dump(self, f: BinaryIO, records: Iterable[Tuple[str, bytes]]):
+        """ Write the records as one JSON object
+        """
+        f.write(b"{")
+        sep = b"\n"
+        for obj_id, raw in records:
+            f.write(sep + json.dumps(obj_id).encode() + b": " + raw)
+            sep = b",\n"
+        f.write(b"\n}\n")
+
+    def spans(self, source: bytes) -> Optional[Iterator]:
+        """ Locate the records, None for a single-line JSON file
+        """
+        if source[:2] != b"{\n":
+            return None
+        return self._spans(source)
+
+    def _spans(self, source: bytes) -> Iterator[Tuple[str, int, int]]:
+        """ Yield (id, start, end) of every record line
+        """
+        for match in self.RECORD_LINE.finditer(source):
+            key = match.group(1)
+            if b"\\" in key:
+                key = json.loads(key)
+            else:
+                key = key[1:-1].decode()
+            yield key, match.start(2), match.end(2)
+
+    def load_all(self, source: bytes) -> Dict[str, dict]:
+        """ Return the attributes of every object of a JSON file
+        """
+        return json.loads(source[:])
+
+
+class BinarySerializer():
+    """ Versioned header followed by length-prefixed records
+
+    Each record is its payload and id sizes (RECORD), the UTF-8 id and
+    a compact UTF-8 JSON payload [attributes, {attribute: epoch
+    seconds}], the datetime attributes being stored as integers.
+    Version 1 files, with marshal payloads, are not readable.
+    """
+
+    EXTENSION = ".bin"
+    MAGIC = b"BDB\0"
+    VERSION = 2
+    HEADER = struct.Struct(">4sH")
+    RECORD = struct.Struct(">IH")
+
+    def encode(self, obj) -> bytes:
+        """ Return the JSON payload of obj
+        """
+        fields = {}
+        stamps = {}
+        # a copy: the object may be changed by another thread
+        for key, value in list(obj.__dict__.items()):
+            if key in obj.TRANSIENT:
+                continue
+            if type(value) is datetime:
+                stamps[key] = (value - EPOCH) // SECOND
+            elif key != 'id':
+                fields[key] = value
+        return json.dumps([fields, stamps], separators=(',', ':'),
+                          ensure_ascii=False).encode()
+
+    def decode(self, raw: bytes) -> dict:
+        """ Return the attributes of a record, without its id
+        """
+        fields, stamps = json.loads(raw)
+        for key, value in stamps.items():
+            fields[key] = EPOCH + timedelta(seconds=value)
+        return fields
+
+    def dump(self, f: BinaryIO, records: Iterable[Tuple[str, bytes]]):
+        """ Write the header then every record
+        """
+        f.write(self.HEADER.pack(self.MAGIC, self.VERSION))
+        pack = self.RECORD.pack
+        for obj_id, raw in records:
+            key = obj_id.encode()
+            f.write(pack(len(raw), len(key)) + key + raw)
+
+    def spans(self, source: bytes) -> Iterator[Tuple[str, int, int]]:
+        """ Check the header and locate the records
+        """
+        if len(source) < self.HEADER.size:
+            raise ValueError("truncated binary store header")
+        magic, version = self.HEADER.unpack_from(source, 0)
+        if magic != self.MAGIC:
+            raise ValueError("not a binary store file")
+        if version != self.VERSION:
+            raise ValueError("unsupported store version {}".format(version))
+        return self._spans(source)
+
+    def _spans(self, source: bytes) -> Iterator[Tuple[str, int, int]]:
+        """ Yield (id, start, end) of every record payload
+        """
+        unpack = self.RECORD.unpack_from
+        size = self.RECORD.size
+        pos = self.HEADER.size
+        end = len(source)
+        while pos < end:
+            if pos + size > end:
+                raise ValueError("truncated record at {}".format(pos))
+            length, key_length = unpack(source, pos)
+            if pos + size + key_length + length > end:
+                raise ValueError("truncated record at {}".format(pos))
+            pos += size
+            key = source[pos:pos + key_length].decode()
+            pos += key_length
+            yield key, pos, pos + length
+            pos += length
+
+
+# serializers by the name a class sets in SERIALIZER
+SERIALIZERS = {
+    'json': JsonSerializer(),
+    'binary': BinarySerializer(),
+}
@@ -9,6 +9,10 @@ class User(Base):
     """ User class
     """
 
+    INDEXES = ('email',)
+    SERIALIZER = 'binary'
+    LAZY = True
+
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a User instance
         """
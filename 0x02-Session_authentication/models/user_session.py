@@ -8,6 +8,11 @@ class UserSession(Base):
     """User session class.
     """
 
+    INDEXES = ('session_id',)
+    SERIALIZER = 'binary'
+    STORAGE = 'journal'
+    DURABILITY = 'interval'
+
     def __init__(self, *args: list, **kwargs: dict):
         """Initializes a User session instance.
         """
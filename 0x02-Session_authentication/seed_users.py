@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+""" Seed the User store with generated users
+
+Usage: ./seed_users.py [-n 10000] [--domain hbtn.io]
+"""
+import argparse
+import time
+
+from models.user import User
+
+
+def main():
+    """ Command line entry point
+    """
+    parser = argparse.ArgumentParser(description="Seed fake users")
+    parser.add_argument('-n', '--count', type=int, default=10000,
+                        help="number of users to create")
+    parser.add_argument('--domain', default="hbtn.io",
+                        help="email domain of the users")
+    parser.add_argument('--password', default="H0lbertonSchool98!",
+                        help="clear password of every user")
+    args = parser.parse_args()
+
+    User.load_from_file()
+    start = time.perf_counter()
+    users = []
+    for i in range(args.count):
+        user = User()
+        user.email = "user{}@{}".format(i, args.domain)
+        user.password = args.password
+        user.first_name = "User"
+        user.last_name = str(i)
+        users.append(user)
+    User.bulk_save(users)
+    print("{} users seeded in {:.2f}s, {} in store".format(
+        args.count, time.perf_counter() - start, User.count()))
+
+
+if __name__ == '__main__':
+    main()